@@ -66,7 +66,8 @@ if menu:
                  args=[request.application])], [T('db'), False,
                  URL('index')], [T('state'), False,
                  URL('state')], [T('cache'), False,
-                 URL('ccache')]]
+                 URL('ccache')], [T('timings'), False,
+                 URL('timings')]]
 
 # ##########################################################
 # ## auxiliary functions
@@ -353,6 +354,18 @@ def state():
     return dict()
 
 
+def timings():
+    # Database calls, default actions and their views, probes and MQTT publishes (see modules/Instrument.py)
+    import Instrument
+
+    if request.vars.reset:
+        Instrument.reset()
+        redirect(URL(r=request))
+    return dict(timings=Instrument.stats(),
+                histogram_labels=Instrument.histogram_labels(),
+                enabled=Instrument.enabled())
+
+
 def ccache():
     if is_gae:
         form = FORM(
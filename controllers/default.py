@@ -1,97 +1,216 @@
 import Database
-# TODO: Add controller database as a variable (changing it means editing it in 4-5 places!)
+import Schema
+import HealthProbe
+import Instrument
+import LiveValues
 import Message
+import Publisher
+import QueueLogging
+import os
+import uuid
+import hashlib
+import json
 import time
-import subprocess
-# TODO: Remove this for Production
-import importlib
-importlib.reload(Database)
-importlib.reload(Message)
-
-import logging
+import email.utils
+
+# Outside production pick up changes to the modules without restarting web2py
+# (the pools, probes, publisher etc. are kept across the reload)
+if not configuration.get('app.production'):
+    import importlib
+    importlib.reload(QueueLogging)
+    importlib.reload(Instrument)
+    importlib.reload(LiveValues)
+    importlib.reload(Schema)
+    importlib.reload(Database)
+    importlib.reload(Message)
+    importlib.reload(HealthProbe)
+    importlib.reload(Publisher)
+
+
+# Written to the file by a background thread, at the level set in appconfig.ini
+logger = QueueLogging.get_logger(request.application,
+                                 configuration.get('log.file'),
+                                 configuration.get('log.level'))
+
+# Timings of the actions (and their views), the database calls, probes and MQTT publishes - see timings()
+Instrument.enable(configuration.get('instrument.enabled'))
+
+
+def __timed_action(in_action):
+    # web2py calls each action through response._caller, the view is rendered here (rather than
+    # after the action returns) so that its time is recorded separately
+    name = f"default {request.function}"
+    with Instrument.timed(name, HTTP):
+        output = in_action()
+    if isinstance(output, dict):
+        with Instrument.timed(f"{name} view", HTTP):
+            output = response.render(output)
+    return output
+
+
+if Instrument.enabled():
+    response._caller = __timed_action
+
+# The controller's database - connections are pooled across requests
+controller_database_name = configuration.get('controller.database')
+controller_pool_size = configuration.get('controller.pool_size')
+
+
+def __controller_database():
+    # Everything here only reads, changes go to the controller daemon over MQTT
+    return Database.Database(controller_database_name, logger, controller_pool_size, in_read_only=True)
+
+
+# MQTT messages to the controller go through one long lived connection shared by all requests
+def __publisher():
+    return Publisher.get_publisher(lambda: Message.Message(configuration.get('mqtt.host'),
+                                                           configuration.get('mqtt.port'),
+                                                           configuration.get('mqtt.keepalive'),
+                                                           configuration.get('mqtt.client_id'),
+                                                           when_message, {}, logger),
+                                   configuration.get('mqtt.publish_timeout'),
+                                   logger)
+
+
+# Service checks shown on the dashboard - run in the background, index just reads the last results
+def __health_monitor():
+    probes = {"Controller": ['systemctl', 'is-active', 'controller'],
+              "ISG": [os.path.join(request.folder, 'modules', 'checkisg.sh')],
+              "MyController": [os.path.join(request.folder, 'modules', 'checkmyc.sh')]
+              }
+    return HealthProbe.get_monitor(probes,
+                                   configuration.get('health.interval'),
+                                   configuration.get('health.ttl'),
+                                   configuration.get('health.timeout'),
+                                   logger)
 
 
-if request.application not in logging.root.manager.loggerDict:
-    logger = logging.getLogger(request.application)
-    logger.setLevel(logging.DEBUG)
-    f_handler = logging.FileHandler("/var/log/web2py/web2py.log")
-    f_handler.setLevel(logging.DEBUG)
-    f_format = logging.Formatter("%(asctime)s:%(levelname)s: %(message)s")
-    f_handler.setFormatter(f_format)
-    logger.addHandler(f_handler)
-else:
-    logger = logging.getLogger(request.application)
+# The dashboard's variants, all rendered by views/default/index.html
+#   prog_page: the page the programme links go to
+#   controls: on / off buttons and next switch inputs, otherwise the state and a link to the programme
+#   heating_control: an on / off button for the heating circuit as well
+#   live: the services' health and power use, with the values kept up to date in the page
+dashboard_variants = {
+    "index": dict(prog_page='prog.html', controls=True, heating_control=True, live=True),
+    "indexB": dict(prog_page='progB.html', controls=True, heating_control=False, live=False),
+    "indexZ": dict(prog_page='prog.html', controls=False, heating_control=False, live=False),
+}
 
 
 def index():
-    my_database = Database.Database("/home/pi/controller/controller/controller.db", logger)
+    return __dashboard("index")
+
+
+def __dashboard(in_variant):
+    # The page's own css / js go in response.files to be concatenated with the rest
+    response.files.append(URL('static', 'css/dashboard.css'))
+    response.files.append(URL('static', 'js/dashboard.js'))
+    response.view = 'default/index.html'
+    my_database = __controller_database()
     # response.flash = T("Hello World")
-    sensors = my_database.read_all_sensors()
+    # Sensor values plus relay states and next switch times
+    sensors = my_database.dashboard_snapshot()
 
-    controllerProcess = subprocess.run(['systemctl', 'is-active',  'controller'],
-                             stdout=subprocess.PIPE,
-                             universal_newlines=True)
-    controllerProcess
+    # These are not really sensors!
+    for service, result in __health().items():
+        sensors[f"{service} status"] = result["status"]
+        sensors[f"{service} state"] = result["state"]
+        sensors[f"{service} checked"] = result["checked"]
 
-    ISGProcess = subprocess.run(['applications/ha1/modules/checkisg.sh'],
-                                       stdout=subprocess.PIPE,
-                                       universal_newlines=True)
-    ISGProcess
+    return dict(message=sensors, live_version=__live_version(sensors), variant=dashboard_variants[in_variant])
 
-    MyCProcess = subprocess.run(['applications/ha1/modules/checkmyc.sh'],
-                                       stdout=subprocess.PIPE,
-                                       universal_newlines=True)
-    MyCProcess
 
-    # These are not really sensors!
-    sensors["HC is on"] = my_database.hp_is_on("HC")
-    sensors["DHW is on"] = my_database.hp_is_on("DHW")
-    sensors["HC next switch"] = my_database.next_relay_switch_time("HC")[0:5]
-    sensors["DHW next switch"] = my_database.next_relay_switch_time("DHW")[0:5]
-    sensors["Radiators next switch"] = my_database.next_relay_switch_time("Radiators relay")[0:5]
-    sensors["Ufloor ground next switch"] = my_database.next_relay_switch_time("Ufloor ground relay")[0:5]
-    sensors["Ufloor first next switch"] = my_database.next_relay_switch_time("Ufloor first relay")[0:5]
-    sensors["Controller status"] = controllerProcess.stdout
-    sensors["ISG status"] = ISGProcess.stdout
-    sensors["MyController status"] = MyCProcess.stdout
+def __health():
+    health_monitor = __health_monitor()
+    return {service: health_monitor.status(service) for service in health_monitor.probes.keys()}
 
-    return dict(message=sensors)
+
+# The dashboard values the page updates in place are kept against a digest of them (see LiveValues)
+# so that dashboardchanges can send just what has changed since the browser's version
+live_snapshot_expire = 600
+
+
+def __live_values(in_snapshot):
+    return {name: value for name, value in in_snapshot.items()
+            if not name.endswith((" status", " state", " checked"))}
+
+
+def __live_version(in_snapshot):
+    live_values = __live_values(in_snapshot)
+    version = hashlib.md5(json.dumps(live_values, sort_keys=True).encode()).hexdigest()
+    LiveValues.remember(version, live_values, live_snapshot_expire)
+    return version
+
+
+def dashboardchanges():
+    # Long poll for the dashboard: returns as soon as controller.db changes the values the browser has
+    # (or after live.poll_timeout with no changes)
+    # Parameters: version (from the page or the last poll)
+    my_database = __controller_database()
+
+    deadline = time.monotonic() + configuration.get('live.poll_timeout')
+    while True:
+        data_version = my_database.data_version()
+        snapshot = my_database.dashboard_snapshot()
+        version = __live_version(snapshot)
+        remaining = deadline - time.monotonic()
+        if version != request.vars["version"] or remaining <= 0:
+            break
+        my_database.wait_for_change(data_version, remaining)
+
+    current_values = __live_values(snapshot)
+    # A version that has expired (or came from another process) sends all the values
+    previous_values = LiveValues.recall(request.vars["version"]) or {}
+    changes = {name: value for name, value in current_values.items() if previous_values.get(name) != value}
+
+    return response.json({"version": version, "changes": changes})
 
 
 def indexB():
-    return index()
+    return __dashboard("indexB")
+
+
+def indexZ():
+    return __dashboard("indexZ")
 
 
 def prog():
-    logger.debug(f"prog {request.vars}")
-    my_database = Database.Database("/home/pi/controller/controller/controller.db", logger)
+    logger.debug("prog %s", request.vars)
+    response.files.append(URL('static', 'js/prog.js'))
+    response.view = 'default/prog.html'
+    my_database = __controller_database()
     return dict(message=my_database.read_prog(request.vars["sensor"]))
 
+
 def progB():
-    logger.debug(f"progB {request.vars}")
+    logger.debug("progB %s", request.vars)
     return prog()
 
 
+# The programmes shown by allprog, by sensor
+programme_titles = {"DHW" : "Hot water"
+                    , "HC": "Heating"
+                    , "Radiators relay": "Radiators"
+                    , "Ufloor ground relay": "Ufloor ground"
+                    , "Ufloor first relay": "Ufloor first"
+                    }
+
+
+def __all_programmes(in_database):
+    programmes = in_database.read_progs(list(programme_titles.keys()))
+    return {title: programmes[sensor] for sensor, title in programme_titles.items()}
+
+
 def allprog():
-    logger.debug(f"allprog {request.vars}")
-    my_database = Database.Database("/home/pi/controller/controller/controller.db", logger)
-    all_progs = {}
-    titles = {"DHW" : "Hot water"
-            , "HC": "Heating"
-            , "Radiators relay": "Radiators"
-            , "Ufloor ground relay": "Ufloor ground"
-            , "Ufloor first relay": "Ufloor first"
-              }
-    for sensor in titles.keys():
-        all_progs[titles[sensor]] = my_database.read_prog(sensor)
-    return dict(message=all_progs)
+    logger.debug("allprog %s", request.vars)
+    my_database = __controller_database()
+    return dict(message=__all_programmes(my_database))
 
 
 def setsensor():
     # Parameters: sensor value [time]
-    logger.debug(f"setsensor {request.vars}")
-    my_message = Message.Message("homeserver", 1883, 60, "web2py", when_message, {}, logger)
-    my_database = Database.Database("/home/pi/controller/controller/controller.db", logger)
+    logger.debug("setsensor %s", request.vars)
+    my_database = __controller_database()
 
     send_value = request.vars["value"]
 
@@ -100,50 +219,195 @@ def setsensor():
         send_value = f"{send_value},{request.vars['time']}"
 
     # TODO If this is just a "normal" set sensor (with no intervals - eg. Comfort temp) then do not try to return the next switch time
-    my_message.set_sensor_control(request.vars["sensor"], send_value)
-    time.sleep(1)
+    # Return as soon as the controller has written this change rather than after a fixed wait
+    # (not just any write - the controller is writing sensor readings all the time)
+    change_token = my_database.sensor_change_token(request.vars["sensor"])
+    __publisher().publish("set_sensor_control", request.vars["sensor"], send_value)
+    my_database.wait_for_sensor_change(request.vars["sensor"], change_token,
+                                       configuration.get('controller.change_timeout'))
     nextRelay = my_database.next_relay_switch_time_value(request.vars["sensor"], request.vars["value"])
     if len(nextRelay) == 0:
         return dict(message="Ok")
-    return dict(message=my_database.next_relay_switch_time_value(request.vars["sensor"], request.vars["value"])[0:5])
+    return dict(message=nextRelay[0:5])
 
 
 def settrigger():
     # Parameters: sensor day group 0/1 time
-    logger.debug(f"settrigger {request.vars}")
-    my_message = Message.Message("homeserver", 1883, 60, "web2py", when_message, {}, logger)
+    logger.debug("settrigger %s", request.vars)
 
-    return my_message.set_trigger_control(request.vars["sensor"], request.vars["day"], request.vars["group"],
-                                          request.vars["value"], request.vars["time"])
+    return __publisher().publish("set_trigger_control", request.vars["sensor"], request.vars["day"],
+                                 request.vars["group"], request.vars["value"], request.vars["time"])
 
 
 def when_message(client, userdata, msg):
     # This is a dummy method just for the Message object above and elsewhere
     pass
 
+# Saving session changes published but possibly not yet applied by the controller
+# are kept for this long against the token handed back to the browser
+pending_savingsession_expire = 60
+
+
 def savingsessions():
-    my_database = Database.Database("/home/pi/controller/controller/controller.db", logger)
+    my_database = __controller_database()
     # response.flash = T("Hello World")
-    time.sleep(3)
-    existing_session = my_database.read_savingsession()
+
+    # Only wait if we have been sent here after a change that may not have been applied yet
+    previous_session = None
+    if request.vars["token"]:
+        pending_key = f"savingsession/{request.vars['token']}"
+        previous_session = cache.ram(pending_key, lambda: None, time_expire=pending_savingsession_expire)
+        cache.ram(pending_key, None)
+
+    if previous_session is None:
+        existing_session = my_database.read_savingsession()
+    else:
+        existing_session = my_database.read_savingsession_changed(previous_session,
+                                                                  configuration.get('controller.change_timeout'))
     return dict(message=existing_session)
 
+
+def __pending_savingsession(in_database):
+    # Remember the session as it is before the change and hand a token back so savingsessions can wait for it
+    token = uuid.uuid4().hex
+    previous_session = in_database.read_savingsession()
+    cache.ram(f"savingsession/{token}", lambda: previous_session, time_expire=pending_savingsession_expire)
+    response.headers["X-Pending-Token"] = token
+    return token
+
+
 def setsavingsession():
     # Parameters: dayofweek start(time) (endtime)
-    logger.debug(f"setsavingsession {request.vars}")
-    my_message = Message.Message("homeserver", 1883, 60, "web2py", when_message, {}, logger)
+    logger.debug("setsavingsession %s", request.vars)
+    __pending_savingsession(__controller_database())
 
-    return my_message.set_savingsession_control(request.vars["dayofweek"], request.vars["start"], request.vars["end"])
+    return __publisher().publish("set_savingsession_control",
+                                 request.vars["dayofweek"], request.vars["start"], request.vars["end"])
 
 def deletesavingsession():
     # Parameters: dayofweek start(time) (endtime)
-    logger.debug(f"setsavingsession {request.vars}")
-    my_message = Message.Message("homeserver", 1883, 60, "web2py", when_message, {}, logger)
+    logger.debug("setsavingsession %s", request.vars)
+    __pending_savingsession(__controller_database())
+
+    return __publisher().publish("set_savingsession_control")
+
+def history():
+    # Parameters: sensor (one or more SensorIds) [start] [end] (seconds since the epoch, default the last week)
+    #             [bucket] (seconds, default an hour)
+    logger.debug("history %s", request.vars)
+    my_database = __controller_database()
+
+    try:
+        sensor_ids = [int(sensor_id) for sensor_id in request.vars.getlist("sensor")]
+        end = int(request.vars["end"] or time.time())
+        start = int(request.vars["start"] or end - 7 * 86400)
+        bucket = int(request.vars["bucket"] or 3600)
+    except (TypeError, ValueError):
+        raise HTTP(400, "sensor, start, end and bucket must be whole numbers")
+    if len(sensor_ids) == 0 or bucket <= 0:
+        raise HTTP(400, "sensor and a positive bucket are required")
+
+    # Written out as the rows are read rather than building the whole list first
+    def stream(in_rows):
+        yield b'{"history": ['
+        separator = b""
+        for row in in_rows:
+            yield separator + json.dumps(row).encode()
+            separator = b","
+        yield b"]}"
+
+    raise HTTP(200, stream(my_database.sensor_history(sensor_ids, start, end, bucket)),
+               **{"Content-Type": "application/json"})
+
+
+def timings():
+    # Counts, latency histograms and rows from Instrument, for this process since it started (or reset=1)
+    if request.vars["reset"]:
+        Instrument.reset()
+    return response.json(Instrument.stats())
+
+
+def lockwaits():
+    # How long this process's statements have waited for database locks (contention with the controller daemon)
+    return response.json(Database.lock_wait_stats())
+
+
+# ---- JSON API -----
+# The same data as index, prog, allprog and savingsessions for polling clients (eg. the tablet).
+# Each sends an ETag and Last-Modified from the data versions in controller.db and answers
+# 304 Not Modified, without reading or working anything out, if the client already has it
+
+def __not_modified(in_etag, in_last_modified):
+    # Returns the validator headers to send with the response, or raises 304 if the client's copy is current
+    headers = {"ETag": f'"{in_etag}"',
+               "Last-Modified": email.utils.formatdate(in_last_modified, usegmt=True),
+               "Cache-Control": "no-cache"}
+
+    if request.env.http_if_none_match:
+        # Takes precedence over If-Modified-Since
+        client_tags = [tag.strip().replace("W/", "", 1) for tag in request.env.http_if_none_match.split(",")]
+        if headers["ETag"] in client_tags or "*" in client_tags:
+            raise HTTP(304, **headers)
+    elif request.env.http_if_modified_since:
+        try:
+            since = email.utils.parsedate_to_datetime(request.env.http_if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            since = None
+        if since is not None and in_last_modified <= since:
+            raise HTTP(304, **headers)
+
+    return headers
+
+
+def __api_response(in_headers, in_data):
+    response.headers.update(in_headers)
+    return response.json(in_data)
+
+
+def api_dashboard():
+    my_database = __controller_database()
+    versions = my_database.data_versions()
+
+    # The relay states and next switch times move on with the clock as well as the data,
+    # the programmes switch on the minute
+    minute = int(time.time()) // 60 * 60
+    health = {service: {"status": result["status"], "state": result["state"]}
+              for service, result in __health().items()}
+    health_digest = hashlib.md5(json.dumps(health, sort_keys=True).encode()).hexdigest()[0:8]
+    headers = __not_modified(f"{versions['Sensor'][0]}.{versions['Schedule'][0]}.{minute}.{health_digest}",
+                             max(versions["Sensor"][1], versions["Schedule"][1], minute))
+
+    return __api_response(headers, {"sensors": my_database.dashboard_snapshot(), "health": health})
+
+
+def api_prog():
+    # Parameters: sensor
+    my_database = __controller_database()
+    versions = my_database.data_versions()
+    headers = __not_modified(versions["Schedule"][0], versions["Schedule"][1])
+
+    return __api_response(headers, my_database.read_prog(request.vars["sensor"]))
+
+
+def api_allprog():
+    my_database = __controller_database()
+    versions = my_database.data_versions()
+    headers = __not_modified(versions["Schedule"][0], versions["Schedule"][1])
+
+    return __api_response(headers, __all_programmes(my_database))
+
+
+def api_savingsessions():
+    # The saving session triggers are TimedTriggers, so change the schedule version
+    my_database = __controller_database()
+    versions = my_database.data_versions()
+    headers = __not_modified(versions["Schedule"][0], versions["Schedule"][1])
+
+    return __api_response(headers, my_database.read_savingsession())
 
-    return my_message.set_savingsession_control()
 
 def test():
-    my_database = Database.Database("/home/pi/controller/controller/controller.db", logger)
+    my_database = __controller_database()
     # response.flash = T("Hello World")
     sensors = my_database.read_all_sensors()
     return dict(message=sensors)
@@ -0,0 +1,13 @@
+# Rolls up and prunes the controller's sensor history
+# Run by web2py cron in the application's environment (see cron/crontab)
+import Database
+import QueueLogging
+
+logger = QueueLogging.get_logger(request.application, configuration.get('log.file'), configuration.get('log.level'))
+my_database = Database.Database(configuration.get('controller.database'), logger)
+my_database.history_maintenance({"raw": configuration.get('history.raw_days'),
+                                 "minute": configuration.get('history.minute_days'),
+                                 "hour": configuration.get('history.hour_days'),
+                                 "day": configuration.get('history.day_days')
+                                 })
+my_database.close()
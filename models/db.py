@@ -6,7 +6,9 @@
 # Auth is for authenticaiton and access control
 # -------------------------------------------------------------------------
 from gluon.contrib.appconfig import AppConfig
-from gluon.tools import Auth
+import hashlib
+import os
+from LazyProxy import LazyAuth, LazyProxy
 
 
 # -------------------------------------------------------------------------
@@ -24,17 +26,24 @@ if request.global_settings.web2py_version < "2.15.5":
 # request.requires_https()
 
 # -------------------------------------------------------------------------
-# once in production, remove reload=True to gain full speed
+# in production (app.production in appconfig.ini) the configuration is read
+# once per process, otherwise it is re-read on every request so edits apply
+# straight away
 # -------------------------------------------------------------------------
-configuration = AppConfig(reload=True)
+configuration = AppConfig()
+if not configuration.get('app.production'):
+    configuration = AppConfig(reload=True)
 
 if not request.env.web2py_runtime_gae:
     # ---------------------------------------------------------------------
     # if NOT running on Google App Engine use SQLite or other DB
+    # in production the tables are not checked for migrations and are only
+    # defined when an action first uses them (lazy_tables)
     # ---------------------------------------------------------------------
     db = DAL(configuration.get('db.uri'),
              pool_size=configuration.get('db.pool_size'),
-             migrate_enabled=configuration.get('db.migrate'),
+             migrate_enabled=configuration.get('db.migrate') and not configuration.get('app.production'),
+             lazy_tables=bool(configuration.get('app.production')),
              check_reserved=['all'])
 else:
     # ---------------------------------------------------------------------
@@ -67,15 +76,34 @@ response.formstyle = 'bootstrap4_inline'
 response.form_label_separator = ''
 
 # -------------------------------------------------------------------------
-# (optional) optimize handling of static files
+# the files in response.files (web2py_ajax.html plus any each action adds)
+# are concatenated and minified into one css and one js file per page
 # -------------------------------------------------------------------------
-# response.optimize_css = 'concat,minify,inline'
-# response.optimize_js = 'concat,minify,inline'
+response.optimize_css = 'concat,minify'
+response.optimize_js = 'concat,minify'
 
 # -------------------------------------------------------------------------
-# (optional) static assets folder versioning
+# static assets folder versioning - URL('static', ...) gives /static/_<version>/...
+# which web2py serves with far-future cache headers. The version is a fingerprint
+# of the static files so it changes (and browsers fetch them again) whenever they do
 # -------------------------------------------------------------------------
-# response.static_version = '0.0.0'
+def static_fingerprint():
+    digest = hashlib.md5()
+    static_folder = os.path.join(request.folder, 'static')
+    for folder, folders, files in os.walk(static_folder):
+        # temp is where the concatenated files are written
+        folders[:] = sorted(name for name in folders if name != 'temp')
+        for name in sorted(files):
+            details = os.stat(os.path.join(folder, name))
+            digest.update(f"{os.path.relpath(folder, static_folder)}/{name} "
+                          f"{details.st_size} {details.st_mtime_ns}".encode())
+    # web2py only recognises versions of the form n.n.n
+    return f"1.0.{int(digest.hexdigest()[:8], 16)}"
+
+
+response.static_version = cache.ram('static_version', static_fingerprint,
+                                    time_expire=None if configuration.get('app.production') else 5)
+response.static_version_urls = True
 
 # -------------------------------------------------------------------------
 # Here is sample code if you need for
@@ -87,31 +115,53 @@ response.form_label_separator = ''
 # (more options discussed in gluon/tools.py)
 # -------------------------------------------------------------------------
 
-# host names must be a list of allowed host names (glob syntax allowed)
-auth = Auth(db, host_names=configuration.get('host.names'))
-
 # -------------------------------------------------------------------------
-# create all tables needed by auth, maybe add a list of extra fields
+# Auth (and with it the auth tables and the mailer) is only built when
+# something first uses it - the dashboard actions never do
 # -------------------------------------------------------------------------
-auth.settings.extra_fields['auth_user'] = []
-auth.define_tables(username=False, signature=False)
+auth_actions_disabled = []
 
-# -------------------------------------------------------------------------
-# configure email
-# -------------------------------------------------------------------------
-mail = auth.settings.mailer
-mail.settings.server = 'logging' if request.is_local else configuration.get('smtp.server')
-mail.settings.sender = configuration.get('smtp.sender')
-mail.settings.login = configuration.get('smtp.login')
-mail.settings.tls = configuration.get('smtp.tls') or False
-mail.settings.ssl = configuration.get('smtp.ssl') or False
 
-# -------------------------------------------------------------------------
-# configure auth policy
-# -------------------------------------------------------------------------
-auth.settings.registration_requires_verification = False
-auth.settings.registration_requires_approval = False
-auth.settings.reset_password_requires_verification = True
+def build_auth():
+    from gluon.tools import Auth
+
+    # host names must be a list of allowed host names (glob syntax allowed)
+    auth = Auth(db, host_names=configuration.get('host.names'))
+
+    # ---------------------------------------------------------------------
+    # create all tables needed by auth, maybe add a list of extra fields
+    # ---------------------------------------------------------------------
+    auth.settings.extra_fields['auth_user'] = []
+    auth.define_tables(username=False, signature=False)
+
+    # ---------------------------------------------------------------------
+    # configure email
+    # ---------------------------------------------------------------------
+    mail = auth.settings.mailer
+    mail.settings.server = 'logging' if request.is_local else configuration.get('smtp.server')
+    mail.settings.sender = configuration.get('smtp.sender')
+    mail.settings.login = configuration.get('smtp.login')
+    mail.settings.tls = configuration.get('smtp.tls') or False
+    mail.settings.ssl = configuration.get('smtp.ssl') or False
+
+    # ---------------------------------------------------------------------
+    # configure auth policy
+    # ---------------------------------------------------------------------
+    auth.settings.registration_requires_verification = False
+    auth.settings.registration_requires_approval = False
+    auth.settings.reset_password_requires_verification = True
+    # the layout's menu reads auth_actions_disabled so that it does not build Auth
+    auth.settings.actions_disabled = auth_actions_disabled
+
+    return auth
+
+
+auth = LazyAuth(build_auth, session, request.now)
+mail = LazyProxy(lambda: auth.settings.mailer)
+
+# appadmin lists and manages the auth tables, so needs them defined
+if request.controller == 'appadmin':
+    auth.resolve()
 
 # -------------------------------------------------------------------------  
 # read more at http://dev.w3.org/html5/markup/meta.name.html               
@@ -130,9 +180,17 @@ response.google_analytics_id = configuration.get('google.analytics_id')
 # -------------------------------------------------------------------------
 # maybe use the scheduler
 # -------------------------------------------------------------------------
-if configuration.get('scheduler.enabled'):
+def build_scheduler():
     from gluon.scheduler import Scheduler
-    scheduler = Scheduler(db, heartbeat=configuration.get('scheduler.heartbeat'))
+    return Scheduler(db, heartbeat=configuration.get('scheduler.heartbeat'))
+
+
+if configuration.get('scheduler.enabled'):
+    # the workers (web2py.py -K) need it straight away, web requests only when queuing a task
+    if request.is_scheduler or request.is_shell:
+        scheduler = build_scheduler()
+    else:
+        scheduler = LazyProxy(build_scheduler)
 
 # -------------------------------------------------------------------------
 # Define your tables below (or better in another model file) for example
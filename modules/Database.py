@@ -1,37 +1,624 @@
 
 import sqlite3
 from datetime import datetime
+import math
 import os.path
+import re
+import queue
+import threading
+import time
+import atexit
+import signal
+from bisect import bisect_right
+from Instrument import instrument_methods
+from QueueLogging import SampledLogger
+from Schema import HISTORY_ROLLUPS, INTEGER_KEY_TABLES, check_schema, has_integer_key
 
 
 # This function is used to convert times (HH:MM:SS) to seconds
 def timeConvert(inTime):
     # Commented out as this could impact database performance
-    # self.logger.debug(f"database timeConvert {inTime}")
+    # self.logger.debug("database timeConvert %s", inTime)
     numbers = inTime.split(":")
     return (int(numbers[0])*60 + int(numbers[1])) * 60 + int(numbers[2])
 
 
+# Seconds of the day for a trigger time, which may have been given without the seconds (HH:MM)
+def trigger_seconds(in_time):
+    if len(in_time) < 8:
+        in_time += ":00"
+    return timeConvert(in_time)
+
+
+# Only readings that are finite numbers are rolled up - not "nan" or "inf" (eg. from a failed DHT read),
+# which SQLite would store as NULL and so null out the whole bucket
+NUMERIC_VALUE = re.compile(r"[0-9.eE+-]*[0-9][0-9.eE+-]*")
+
+
+# The reading as a float if it is a finite number, otherwise None
+# Used for the readings as they are written and (as numeric_value()) by the SQL that reads them back
+def numeric_value(in_value):
+    if in_value is None or not NUMERIC_VALUE.fullmatch(str(in_value)):
+        return None
+    try:
+        value = float(in_value)
+    except ValueError:
+        return None
+    return value if math.isfinite(value) else None
+
+
+# The globs are the same test as NUMERIC_VALUE, checked first as they are much cheaper than the function
+NUMERIC_VALUE_SQL = "Value glob '*[0-9]*' and Value not glob '*[^0-9.eE+-]*' and numeric_value(Value) is not null"
+
+
+# Adds readings (from in_source_sql giving SensorId, Bucket, Count, Minimum, Maximum, Total) into a rollup table
+def rollup_upsert_sql(in_level, in_source_sql):
+    return f"""insert into history.sensor_history_{in_level} (SensorId, Bucket, Count, Minimum, Maximum, Total)
+            {in_source_sql}
+            on conflict (SensorId, Bucket) do update
+            set Count = Count + excluded.Count,
+                Minimum = min(Minimum, excluded.Minimum),
+                Maximum = max(Maximum, excluded.Maximum),
+                Total = Total + excluded.Total"""
+
+
+# Database files whose schema this process has checked (kept when the module is reloaded)
+_checked = globals().get("_checked", set())
+# Database files this process has seen in WAL mode
+_wal = globals().get("_wal", set())
+# For each of those, the tables where SQLite allocates the ids
+_integer_key_tables = globals().get("_integer_key_tables", {})
+# For each of those, the SensorVersion last read and when this process first saw it
+_sensor_versions = globals().get("_sensor_versions", {})
+
+
+# SQLite's own busy handler only waits briefly, LockTimedCursor retries (and times) anything longer
+BUSY_TIMEOUT = 0.05
+# Give up on a lock after this many seconds, as the original 5 second timeout
+LOCK_TIMEOUT = 5
+# In WAL mode a transaction whose snapshot is out of date can never get the write lock, retrying does not help
+SQLITE_BUSY_SNAPSHOT = 517
+
+# Lock waits across the whole process (kept when the module is reloaded)
+_lock_waits = globals().get("_lock_waits", {"waits": 0, "seconds": 0.0, "max_seconds": 0.0, "timeouts": 0})
+_lock_waits_lock = globals().get("_lock_waits_lock", threading.Lock())
+
+
+def lock_wait_stats():
+    # How often statements have had to wait for another connection's lock and for how long
+    with _lock_waits_lock:
+        return dict(_lock_waits)
+
+
+def record_lock_wait(in_seconds, in_timed_out):
+    with _lock_waits_lock:
+        _lock_waits["waits"] += 1
+        _lock_waits["seconds"] += in_seconds
+        _lock_waits["max_seconds"] = max(_lock_waits["max_seconds"], in_seconds)
+        if in_timed_out:
+            _lock_waits["timeouts"] += 1
+
+
+# Calls in_call, retrying with a short backoff while the database is locked by another connection
+def retry_locked(in_call, in_args):
+    started = time.monotonic()
+    delay = 0.01
+    waited = False
+    while True:
+        try:
+            result = in_call(*in_args)
+        except sqlite3.OperationalError as error:
+            elapsed = time.monotonic() - started
+            if "locked" not in str(error) or getattr(error, "sqlite_errorcode", None) == SQLITE_BUSY_SNAPSHOT:
+                raise
+            if elapsed >= LOCK_TIMEOUT:
+                record_lock_wait(elapsed, True)
+                raise
+            waited = True
+            time.sleep(min(delay, LOCK_TIMEOUT - elapsed))
+            delay = min(delay * 2, 0.2)
+            continue
+
+        if waited:
+            record_lock_wait(time.monotonic() - started, False)
+        return result
+
+
+class LockTimedCursor(sqlite3.Cursor):
+    def execute(self, *in_args):
+        return retry_locked(super().execute, in_args)
+
+    def executemany(self, *in_args):
+        return retry_locked(super().executemany, in_args)
+
+
+class LockTimedConnection(sqlite3.Connection):
+    # Every statement goes through LockTimedCursor, including the connection's execute shortcuts
+
+    def cursor(self, factory=LockTimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *in_args):
+        return self.cursor().execute(*in_args)
+
+    def executemany(self, *in_args):
+        return self.cursor().executemany(*in_args)
+
+    def commit(self):
+        return retry_locked(super().commit, ())
+
+    def __exit__(self, in_type, in_value, in_traceback):
+        # "with connection:" commits in C without calling commit() above, so would only wait BUSY_TIMEOUT
+        if in_type is None:
+            try:
+                self.commit()
+            except BaseException:
+                self.rollback()
+                raise
+        else:
+            self.rollback()
+        return False
+
+
+# Opens a connection to the controller database with the UDFs and attached databases the queries expect
+# web2py only reads, so gets read only connections (in_read_only) - the controller daemon does the writing
+def connect(inDatabaseFilename, inLogger, in_read_only=False, in_check_schema=True):
+    # TODO Parameterise the history database
+    history_database_name = f"{os.path.dirname(inDatabaseFilename)}/controller_history.db"
+
+    if in_read_only:
+        # Pooled connections are handed between web2py worker threads, one at a time
+        connection = sqlite3.connect(f"file:{inDatabaseFilename}?mode=ro", uri=True, timeout=BUSY_TIMEOUT,
+                                     check_same_thread=False, factory=LockTimedConnection)
+        connection.execute(f"attach database 'file:{history_database_name}?mode=ro' as 'history'")
+    else:
+        connection = sqlite3.connect(inDatabaseFilename, timeout=BUSY_TIMEOUT,
+                                     check_same_thread=False, factory=LockTimedConnection)
+        connection.execute(f"attach database '{history_database_name}' as 'history'")
+    connection.row_factory = sqlite3.Row
+
+    # No longer used by these queries (see TimedTrigger.Seconds) but kept for any ad hoc SQL
+    connection.create_function("to_seconds", 1, timeConvert)
+    connection.create_function("numeric_value", 1, numeric_value, deterministic=True)
+
+    # Durable against a crash of the process (if not a power cut) with far fewer fsyncs in WAL mode
+    for schema in ("main", "history"):
+        connection.execute(f"pragma {schema}.synchronous = normal")
+
+    # WAL lets the dashboard read while the controller daemon writes. It is stored in the database file
+    # so only has to succeed once, but it cannot be changed while another process has the file open
+    # - so each writable connection tries again until it has
+    if not in_read_only and inDatabaseFilename not in _wal:
+        modes = []
+        for schema in ("main", "history"):
+            try:
+                modes.append(connection.execute(f"pragma {schema}.journal_mode = wal").fetchone()[0])
+            except sqlite3.OperationalError as error:
+                if "locked" not in str(error):
+                    raise
+                modes.append(str(error))
+        if modes == ["wal", "wal"]:
+            _wal.add(inDatabaseFilename)
+        else:
+            inLogger.warning("database %s not in WAL mode yet (main, history): %s", inDatabaseFilename, modes)
+
+    # Only needs checking once per database file per process - the migrations are a separate step
+    # (python modules/Schema.py --migrate), Schema.migrate_database is the only caller that skips this
+    if in_check_schema and inDatabaseFilename not in _checked:
+        check_schema(connection, inDatabaseFilename)
+        _integer_key_tables[inDatabaseFilename] = {table.lower() for table in INTEGER_KEY_TABLES
+                                                   if has_integer_key(connection, table)}
+        _checked.add(inDatabaseFilename)
+
+    return connection
+
+
+class ConnectionPool:
+    # Keeps up to pool_size idle connections so that each web2py request does not have to
+    # open the database, register the UDFs and attach the history database again
+
+    def __init__(self, inDatabaseFilename, in_pool_size, in_read_only, inLogger):
+        self.logger = inLogger
+        self.logger.debug("pool __init__ %s %s %s", inDatabaseFilename, in_pool_size, in_read_only)
+        self.database_filename = inDatabaseFilename
+        self.read_only = in_read_only
+        self.pool_size = in_pool_size
+        # Most recently used first, so a quiet period only keeps one connection warm
+        self.idle = queue.LifoQueue(maxsize=in_pool_size)
+
+    def acquire(self):
+        # Hand out an idle connection if a healthy one is available, otherwise open a new one
+        while True:
+            try:
+                connection = self.idle.get_nowait()
+            except queue.Empty:
+                self.logger.debug("pool acquire new connection %s", self.database_filename)
+                return connect(self.database_filename, self.logger, self.read_only)
+
+            if self.healthy(connection):
+                return connection
+
+            self.logger.debug("pool acquire discarding unhealthy connection %s", self.database_filename)
+            self.discard(connection)
+
+    def release(self, in_connection):
+        # Anything left uncommitted would have been lost when the connection closed, so do the same here
+        try:
+            if in_connection.in_transaction:
+                in_connection.rollback()
+        except sqlite3.Error as error:
+            # Closed, or typically "database is locked" - do not hand this one out again
+            self.logger.debug("pool release rollback failed %s", error)
+            self.discard(in_connection)
+            return
+
+        try:
+            self.idle.put_nowait(in_connection)
+        except queue.Full:
+            self.discard(in_connection)
+
+    def healthy(self, in_connection):
+        # A closed handle raises ProgrammingError, a broken one OperationalError
+        try:
+            if in_connection.in_transaction:
+                return False
+            in_connection.execute("select 1").fetchone()
+        except sqlite3.Error:
+            return False
+        return True
+
+    def discard(self, in_connection):
+        try:
+            in_connection.close()
+        except sqlite3.Error:
+            pass
+
+
+# Process wide pools, one per database file (and read only or not).
+# These are kept when the module is reloaded (the web2py controller reloads it) so that the
+# connections really are reused across requests
+_pools = globals().get("_pools", {})
+_pools_lock = globals().get("_pools_lock", threading.Lock())
+
+
+def get_pool(inDatabaseFilename, in_pool_size, in_read_only, inLogger):
+    with _pools_lock:
+        pool = _pools.get((inDatabaseFilename, in_read_only))
+        if pool is None or pool.pool_size != in_pool_size:
+            pool = ConnectionPool(inDatabaseFilename, in_pool_size, in_read_only, inLogger)
+            _pools[(inDatabaseFilename, in_read_only)] = pool
+        return pool
+
+
+class HistoryWriter:
+    # Buffers history.sensor_history rows and writes them in one transaction once there are
+    # in_batch_rows of them or the oldest has waited in_batch_ms, rather than one write per reading.
+    # It has its own connection so that a flush from the timer thread cannot commit (or be caught up in)
+    # a transaction the caller has open on the main one
+
+    def __init__(self, in_database_filename, in_batch_rows, in_batch_ms, inLogger):
+        self.logger = inLogger
+        self.logger.debug("history __init__ %s %s", in_batch_rows, in_batch_ms)
+        self.database_filename = in_database_filename
+        # Opened on the first flush - read only users (web2py) never write history
+        self.dbConnection = None
+        self.batch_rows = in_batch_rows
+        self.batch_seconds = in_batch_ms / 1000
+
+        self.lock = threading.Lock()
+        self.rows = []
+        # Writes the rows once the oldest has waited batch_seconds, even if no more readings arrive
+        self.timer = None
+
+    def add(self, in_sensor_id, in_value, in_time):
+        with self.lock:
+            if len(self.rows) == 0:
+                self.start_timer()
+                # Make sure whatever is buffered gets written if the process exits normally
+                atexit.register(self.flush)
+            self.rows.append((in_sensor_id, in_value, in_time))
+            full = len(self.rows) >= self.batch_rows
+        if full:
+            self.flush()
+
+    def queue_depth(self):
+        return len(self.rows)
+
+    def start_timer(self):
+        self.timer = threading.Timer(self.batch_seconds, self.timed_flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def timed_flush(self):
+        try:
+            self.flush()
+        except Exception as error:
+            # The rows are still buffered - try again after another batch_seconds
+            self.logger.error("history timed flush failed %r", error)
+            with self.lock:
+                if len(self.rows) > 0:
+                    self.start_timer()
+
+    def flush(self):
+        with self.lock:
+            if len(self.rows) == 0:
+                return
+            self.logger.debug("history flush %s", len(self.rows))
+            rollup_rows = []
+            for sensor_id, value, reading_time in self.rows:
+                value = numeric_value(value)
+                if value is not None:
+                    rollup_rows.append((sensor_id, reading_time, value))
+
+            if self.dbConnection is None:
+                self.dbConnection = connect(self.database_filename, self.logger)
+            with self.dbConnection:
+                self.dbConnection.executemany(
+                    """insert into history.sensor_history (SensorId, Value, Time)
+                        values (?, ?, ?)""",
+                    self.rows)
+                for level, width in HISTORY_ROLLUPS.items():
+                    self.dbConnection.executemany(
+                        rollup_upsert_sql(level, "values (?, ?, 1, ?, ?, ?)"),
+                        [(sensor_id, reading_time - reading_time % width, value, value, value)
+                         for sensor_id, reading_time, value in rollup_rows])
+            self.rows = []
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            atexit.unregister(self.flush)
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.dbConnection is not None:
+                self.dbConnection.close()
+                self.dbConnection = None
+
+
+def close_on_sigterm(in_database):
+    # systemd (systemctl stop) stops the controller daemon with SIGTERM, which skips atexit and so would
+    # lose the buffered history. Call this from the daemon's main thread once its Database is open:
+    #     my_database = Database.Database(filename, logger)
+    #     Database.close_on_sigterm(my_database)
+    # SIGTERM then closes the database (writing out the history) and exits as sys.exit() would
+    def handler(in_signal, in_frame):
+        in_database.logger.info("SIGTERM, closing %s", in_database.database_filename)
+        in_database.close()
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, handler)
+
+
+# Compiled schedules by (database file, sensor name): (ScheduleVersion, WeeklySchedule)
+# Kept when the module is reloaded so they are shared by all web2py requests
+_schedules = globals().get("_schedules", {})
+
+# Programmes as returned by read_prog, by (database file, sensor name): (ScheduleVersion, programme)
+_programmes = globals().get("_programmes", {})
+
+
+# The relays shown on the dashboard, with the name used for them in the snapshot
+# HC and DHW are not really sensors - their triggers are only used to find the interval
+DASHBOARD_RELAYS = {"HC": "HC",
+                    "DHW": "DHW",
+                    "Radiators relay": "Radiators",
+                    "Ufloor ground relay": "Ufloor ground",
+                    "Ufloor first relay": "Ufloor first"
+                    }
+
+
+SECONDS_PER_DAY = 86400
+SECONDS_PER_WEEK = 7 * SECONDS_PER_DAY
+
+
+# Seconds since midnight on Monday
+def week_seconds(in_datetime):
+    return in_datetime.weekday() * SECONDS_PER_DAY \
+        + (in_datetime.hour * 60 + in_datetime.minute) * 60 + in_datetime.second
+
+
+class WeeklySchedule:
+    # A sensor's triggers compiled into the switches it makes over a week, sorted by time,
+    # so the current interval and next switch are found by binary search rather than a scan of every trigger.
+    # Built from rows with Day (-1 is daily), Seconds, Time, SetValue and Status
+
+    def __init__(self, in_triggers):
+        # Daily triggers happen on every day of the week
+        # A Once trigger masks any other trigger at the same time (eg. keep a relay on past its normal off time)
+        switches = []
+        for trigger in in_triggers:
+            days = range(7) if trigger["Day"] == -1 else [trigger["Day"]]
+            for day in days:
+                masking_order = 0 if trigger["Status"] == "Once" else 1
+                switches.append((day * SECONDS_PER_DAY + trigger["Seconds"], masking_order, trigger))
+        switches.sort(key=lambda switch: switch[0:2])
+
+        self.seconds = []
+        self.triggers = []
+        for second, masking_order, trigger in switches:
+            if len(self.seconds) > 0 and self.seconds[-1] == second:
+                continue
+            self.seconds.append(second)
+            self.triggers.append(trigger)
+
+        # An external interval over midnight is stored as a switch at 23:59:59 and another at 00:00:00
+        # - that is not really a switch so drop the one at 23:59:59
+        count = len(self.seconds)
+        keep = [not (self.triggers[index]["Time"] == "23:59:59"
+                     and self.seconds[(index + 1) % count] == (self.seconds[index] + 1) % SECONDS_PER_WEEK)
+                for index in range(count)]
+        if count > 1:
+            self.seconds = [second for second, kept in zip(self.seconds, keep) if kept]
+            self.triggers = [trigger for trigger, kept in zip(self.triggers, keep) if kept]
+
+        self.values = [trigger["SetValue"] for trigger in self.triggers]
+
+        # For each switch, the next (and previous) switch, round the week, that sets a different value
+        count = len(self.values)
+        self.next_change = [None] * count
+        self.previous_change = [None] * count
+        for index in range(count):
+            for offset in range(1, count):
+                if self.values[(index + offset) % count] != self.values[index]:
+                    self.next_change[index] = (index + offset) % count
+                    break
+            for offset in range(1, count):
+                if self.values[(index - offset) % count] != self.values[index]:
+                    self.previous_change[index] = (index - offset) % count
+                    break
+
+    def __len__(self):
+        return len(self.triggers)
+
+    def index_at(self, in_week_seconds):
+        # The switch in force at the time - before the first switch of the week it is the last one from Sunday
+        return (bisect_right(self.seconds, in_week_seconds) - 1) % len(self.seconds)
+
+    def value_at(self, in_week_seconds):
+        if len(self) == 0:
+            return None
+        return self.values[self.index_at(in_week_seconds)]
+
+    def next_switch(self, in_value, in_week_seconds):
+        # The next switch after the time that sets something other than in_value
+        # If nothing ever does, just the next switch
+        if len(self) == 0:
+            return None
+        following = (self.index_at(in_week_seconds) + 1) % len(self)
+        if self.values[following] != in_value or self.next_change[following] is None:
+            return self.triggers[following]
+        return self.triggers[self.next_change[following]]
+
+    def interval(self, in_value, in_week_seconds):
+        # As current_relay_interval_value: {0: the switch that started the interval, 1: the switch that ends it}
+        # in_value -1 just finds the current interval, otherwise the interval is the one where in_value was set
+        if len(self) == 0:
+            return {}
+
+        current = self.index_at(in_week_seconds)
+        if in_value == -1:
+            in_value = self.values[current]
+
+        start = current
+        for step in range(len(self)):
+            if start is None or self.values[start] == in_value:
+                break
+            start = self.previous_change[start]
+        if start is None or self.values[start] != in_value:
+            start = current
+
+        return {0: self.triggers[start], 1: self.next_switch(in_value, in_week_seconds)}
+
+
+# Timed when instrumentation is enabled (see Instrument)
+@instrument_methods("database")
 class Database:
     # TODO: Database name / location needs to be in a constants import
     # to support web2py use of this class (then doesn't need to be an argument here
 
-    def __init__(self, inDatabaseFilename, inLogger):
+    # in_pool_size is used by web2py to share a pool of connections across requests
+    # Without it the object has its own connection (as the controller daemon uses it)
+    # in_read_only connections (web2py) never take the write lock so never hold up the controller daemon
+    # Sensor history is written in batches of in_history_batch_rows rows or every in_history_batch_ms
+    # Only one in in_log_sample of the calls made for each MQTT message are logged
+    def __init__(self, inDatabaseFilename, inLogger, in_pool_size=None, in_read_only=False,
+                 in_history_batch_rows=50, in_history_batch_ms=10000, in_log_sample=100):
         self.logger = inLogger
-        self.logger.debug(f"database __init__ {inDatabaseFilename}")
+        self.message_logger = SampledLogger(inLogger, in_log_sample)
+        self.logger.debug("database __init__ %s %s %s", inDatabaseFilename, in_pool_size, in_read_only)
 
-        # Set the lock timeout to 5 seconds, which is the default
-        self.dbConnection = sqlite3.connect(inDatabaseFilename, timeout=5)
-        self.dbConnection.row_factory = sqlite3.Row
-
-        self.dbConnection.create_function("to_seconds", 1, timeConvert)
-
-        # TODO Parameterise the history database
-        history_database_name = f"{os.path.dirname(inDatabaseFilename)}/controller_history.db"
-        self.dbConnection.execute(f"attach database '{history_database_name}' as 'history'")
+        if in_pool_size:
+            self.pool = get_pool(inDatabaseFilename, in_pool_size, in_read_only, inLogger)
+            self.dbConnection = self.pool.acquire()
+        else:
+            self.pool = None
+            self.dbConnection = connect(inDatabaseFilename, inLogger, in_read_only)
+
+        self.database_filename = inDatabaseFilename
+        self.integer_key_tables = _integer_key_tables.get(inDatabaseFilename, set())
+        self.history = HistoryWriter(inDatabaseFilename, in_history_batch_rows, in_history_batch_ms, inLogger)
+
+    def close(self):
+        # Return the connection to the pool (or close it if it is not pooled)
+        if self.dbConnection is None:
+            return
+        self.history.close()
+        if self.pool is not None:
+            self.pool.release(self.dbConnection)
+        else:
+            self.dbConnection.close()
+        self.dbConnection = None
+
+    def __del__(self):
+        # web2py drops the object at the end of each request
+        if getattr(self, "dbConnection", None) is not None:
+            self.close()
+
+    def data_version(self):
+        # Changes whenever another connection (eg. the controller daemon) commits to the database
+        return self.dbConnection.execute("pragma data_version").fetchone()[0]
+
+    def wait_for_change(self, in_data_version, in_timeout, in_settle=0.05):
+        # Wait until another connection has committed since in_data_version was read
+        # Returns True if a change was seen before the timeout
+        self.logger.debug("database wait_for_change %s %s", in_data_version, in_timeout)
+        return self._wait_until_changed(self.data_version, in_data_version, in_timeout, in_settle)
+
+    def sensor_change_token(self, in_sensor_name):
+        # Changes when the sensor's value or the programmes (eg. a Once trigger for it) change - unlike
+        # data_version, the readings the controller writes for other sensors do not change it
+        cursor = self.dbConnection.cursor()
+        cursor.execute(
+            """select (select Value from State where Name = "ScheduleVersion"),
+                (select CurrentValue from Sensor where SensorName = ?)
+            """,
+            (in_sensor_name,))
+        row = cursor.fetchone()
+        cursor.close()
+        return tuple(row)
+
+    def wait_for_sensor_change(self, in_sensor_name, in_token, in_timeout, in_settle=0.05):
+        # Wait until sensor_change_token(in_sensor_name) is no longer in_token
+        # Returns True if a change was seen before the timeout
+        self.logger.debug("database wait_for_sensor_change %s %s %s", in_sensor_name, in_token, in_timeout)
+        # Only read the token again when something has been committed
+        last_seen = {"data_version": None, "token": in_token}
+
+        def read_token():
+            data_version = self.data_version()
+            if data_version != last_seen["data_version"]:
+                last_seen["data_version"] = data_version
+                last_seen["token"] = self.sensor_change_token(in_sensor_name)
+            return last_seen["token"]
+
+        return self._wait_until_changed(read_token, in_token, in_timeout, in_settle)
+
+    def _wait_until_changed(self, in_read, in_value, in_timeout, in_settle):
+        # Poll in_read() with a short backoff until it is no longer in_value
+        # Once it has changed, carry on until it has been the same for in_settle seconds
+        # as the controller may write the Sensor and TimedTrigger changes separately
+        deadline = time.monotonic() + in_timeout
+        delay = 0.01
+        changed = False
+        while True:
+            current_value = in_read()
+            if current_value != in_value:
+                changed = True
+                in_value = current_value
+                settle_until = time.monotonic() + in_settle
+                delay = 0.01
+            elif changed and time.monotonic() >= settle_until:
+                return True
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return changed
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.2)
 
     def getLastSeconds(self):
-        self.logger.debug(f"database getLastSeconds")
+        self.logger.debug("database getLastSeconds")
         cursor = self.dbConnection.cursor()
         cursor.execute(
                 """select Value
@@ -44,7 +631,7 @@ class Database:
         return row[0]
 
     def setLastSeconds(self, inLastSeconds):
-        self.logger.debug(f"database setLastSeconds {inLastSeconds}")
+        self.logger.debug("database setLastSeconds %s", inLastSeconds)
         cursor = self.dbConnection.cursor()
         cursor.execute(
                 """Update State
@@ -58,23 +645,23 @@ class Database:
         return 0
 
     def gatewayNames(self):
-        self.logger.debug(f"database gatewayNames")
+        self.logger.debug("database gatewayNames")
         return [name[0] for name in self.dbConnection.execute("select GatewayName from gateway").fetchall()]
 
     def gatewayIds(self):
-        self.logger.debug(f"database gatewayIds")
+        self.logger.debug("database gatewayIds")
         return [name[0] for name in self.dbConnection.execute("select GatewayId from gateway").fetchall()]
 
     def gatewaySubscribes(self):
-        self.logger.debug(f"database gatewaySubscribes")
+        self.logger.debug("database gatewaySubscribes")
         return [name[0] for name in self.dbConnection.execute("select SubscribeTopic from gateway").fetchall()]
 
     def gatewayPublishes(self):
-        self.logger.debug(f"database gatewayPublishes")
+        self.logger.debug("database gatewayPublishes")
         return [name[0] for name in self.dbConnection.execute("select PublishTopic from gateway").fetchall()]
 
     def gatewayFindFromSubscribeTopic(self, inSubscribeTopic):
-        self.logger.debug(f"database gatewayFindFromSubscribeTopic {inSubscribeTopic}")
+        self.message_logger.debug("database gatewayFindFromSubscribeTopic %s", inSubscribeTopic)
         cursor = self.dbConnection.cursor()
         cursor.execute(
                 """select GatewayId, GatewayName,
@@ -89,7 +676,7 @@ class Database:
         return row
 
     def nodeFindFromMyNode(self, inGatewayId, inMyNode):
-        self.logger.debug(f"database nodeFindFromMyNode {inGatewayId}, {inMyNode}")
+        self.message_logger.debug("database nodeFindFromMyNode %s, %s", inGatewayId, inMyNode)
         # Should probably do something if find more than one...
         cursor = self.dbConnection.cursor()
         cursor.execute(
@@ -103,7 +690,7 @@ class Database:
         return row["NodeId"]
 
     def sensorFindFromMySensor(self, inNodeId, inMySensor):
-        self.logger.debug(f"database sensorFindFromMySensor {inNodeId}, {inMySensor}")
+        self.message_logger.debug("database sensorFindFromMySensor %s, %s", inNodeId, inMySensor)
         # Should probably do something if find more than one...
         cursor = self.dbConnection.cursor()
         cursor.execute(
@@ -117,8 +704,9 @@ class Database:
         return row[0]
 
     def getNextId(self, inTable):
-        self.logger.debug(f"database getNextId {inTable}")
+        self.logger.debug("database getNextId %s", inTable)
         # Find the next Id for a generic table - start at 1
+        # Only used for tables where SQLite does not allocate the id (see migrate_integer_key)
         cursor = self.dbConnection.cursor()
         sql = "select ifnull(max("+inTable+"id) + 1, 1) from "+inTable
         cursor.execute(sql)
@@ -126,22 +714,34 @@ class Database:
         cursor.close()
         return row[0]
 
+    # Adds the materialised Seconds column whenever a TimedTrigger Time is written
+    def with_trigger_seconds(self, inTable, inValues):
+        if inTable.lower() == "timedtrigger" and "Time" in inValues:
+            return dict(inValues, Seconds=trigger_seconds(inValues["Time"]))
+        return inValues
+
     # Creates a new node row with the values provided (generates the Id column)
     # Also updates the last seen date time
     def object_create(self, inTable, inValues):
-        self.logger.debug(f"database object_create {inTable}, {inValues}")
-        sql1 = "insert into " + inTable + " (" + inTable + "Id,"
-        sql2 = " values (?,"
+        self.logger.debug("database object_create %s, %s", inTable, inValues)
+        inValues = self.with_trigger_seconds(inTable, inValues)
+        sql1 = "insert into " + inTable + " ("
+        sql2 = " values ("
         for column in inValues.keys():
             sql1 = sql1 + column + ","
             sql2 = sql2 + "?,"
         sql1 = sql1 + "LastSeen)"
         sql2 = sql2 + "strftime('%s', 'now'))"
         vals = list(inValues.values())
-        nextObjectId = self.getNextId(inTable)
-        vals.insert(0, nextObjectId)
         cursor = self.dbConnection.cursor()
-        cursor.execute(sql1 + sql2, vals)
+        if inTable.lower() in self.integer_key_tables:
+            # SQLite allocates the id as part of the insert
+            cursor.execute(sql1 + sql2, vals)
+            nextObjectId = cursor.lastrowid
+        else:
+            nextObjectId = self.getNextId(inTable)
+            vals.insert(0, nextObjectId)
+            cursor.execute(sql1.replace("(", "(" + inTable + "Id,", 1) + sql2.replace("(", "(?,", 1), vals)
         self.dbConnection.commit()
         cursor.close()
         return nextObjectId
@@ -157,14 +757,14 @@ class Database:
 
     def object_find(self, in_table, in_filters):
         # Simple search in the table using the provided dict as filters
-        self.logger.debug(f"database object_find {in_table}, {in_filters}")
+        self.logger.debug("database object_find %s, %s", in_table, in_filters)
         sql = f"select * from {in_table} where "
         for column in in_filters.keys():
             sql = sql + column + " =? and "
         # Chop off the final "and"
         sql = sql[:-5]
         vals = list(in_filters.values())
-        self.logger.debug(f"database object_find {sql}, {vals}")
+        self.logger.debug("database object_find %s, %s", sql, vals)
         cursor = self.dbConnection.cursor()
         cursor.execute(sql, vals)
         rows = cursor.fetchall()
@@ -176,7 +776,8 @@ class Database:
         # Takes a key field value with a set of updates and applies to the node row
         # Assumes key column name is "Table"Id, eg. NodeId
         # Also updates the last seen date time
-        self.logger.debug(f"database object_update {inTable}, {inKeyValue}, {inUpdates}")
+        self.logger.debug("database object_update %s, %s, %s", inTable, inKeyValue, inUpdates)
+        inUpdates = self.with_trigger_seconds(inTable, inUpdates)
         sql = "update " + inTable + " set "
         for column in inUpdates.keys():
             sql = sql + column + "=?,"
@@ -193,7 +794,7 @@ class Database:
     # Check if the node exists and create if not
     # We are only provided the owning Gateway and MySensors Node Id
     def nodeCreateUpdate(self, inGatewayId, inMyNode, inValues):
-        self.logger.debug(f"database nodeCreateUpdate {inGatewayId}, {inMyNode}, {inValues}")
+        self.message_logger.debug("database nodeCreateUpdate %s, %s, %s", inGatewayId, inMyNode, inValues)
         nodeFound = self.nodeFindFromMyNode(inGatewayId, inMyNode)
         if nodeFound >= 0:
             self.object_update("Node", nodeFound, inValues)
@@ -204,23 +805,146 @@ class Database:
     # Check if the sensor exists and create if not
     # We are only provided the owning NodeId and MySensors Sensor Id
     def sensor_create_update(self, inNodeId, inMySensor, inValues):
-        self.logger.debug(f"database sensor_create_update {inNodeId}, {inMySensor}, {inValues}")
+        self.message_logger.debug("database sensor_create_update %s, %s, %s", inNodeId, inMySensor, inValues)
         sensor_found = self.sensorFindFromMySensor(inNodeId, inMySensor)
         if sensor_found >= 0:
             self.object_update("Sensor", sensor_found, inValues)
         elif sensor_found == -1:
             sensor_found = self.object_create("Sensor", inValues)
 
-        self.dbConnection.execute(
-            f"""insert into history.sensor_history (SensorId, Value, Time)
-                select sensorid, currentvalue, lastseen
-                from sensor where sensorId = {sensor_found}
-             """)
+        cursor = self.dbConnection.cursor()
+        cursor.execute(
+            """select SensorId, CurrentValue, LastSeen
+                from Sensor
+                where SensorId = ?""",
+            (sensor_found,))
+        row = cursor.fetchone()
+        cursor.close()
+        self.history.add(row["SensorId"], row["CurrentValue"], row["LastSeen"])
 
         return sensor_found
 
+    def flush_history(self):
+        # Write any buffered sensor history now (eg. when the controller is shutting down)
+        self.logger.debug("database flush_history")
+        self.history.flush()
+
+    def history_queue_depth(self):
+        return self.history.queue_depth()
+
+    def rollup_history(self, in_start, in_end):
+        # Adds the raw readings from in_start up to (not including) in_end into the rollups
+        self.logger.debug("database rollup_history %s %s", in_start, in_end)
+        with self.dbConnection:
+            for level, width in HISTORY_ROLLUPS.items():
+                self.dbConnection.execute(
+                    rollup_upsert_sql(level,
+                                      f"""select SensorId, Time - Time % {width}, count(*)
+                                          , min(numeric_value(Value)), max(numeric_value(Value)), total(numeric_value(Value))
+                                          from history.sensor_history
+                                          where Time >= ? and Time < ?
+                                          and {NUMERIC_VALUE_SQL}
+                                          group by SensorId, Time - Time % {width}"""),
+                    (in_start, in_end))
+
+    def sensor_history(self, in_sensor_ids, in_start, in_end, in_bucket):
+        # Min / max / average of each sensor's readings from in_start up to in_end (seconds since the epoch)
+        # in buckets of in_bucket seconds - yields {"SensorId", "Time", "Count", "Minimum", "Maximum", "Average"}
+        # ordered by sensor and time, read from the coarsest rollup the bucket size allows
+        self.logger.debug("database sensor_history %s %s %s %s", in_sensor_ids, in_start, in_end, in_bucket)
+
+        sensor_list = ",".join("?" * len(in_sensor_ids))
+        levels = [level for level, width in HISTORY_ROLLUPS.items() if width <= in_bucket and in_bucket % width == 0]
+        if len(levels) > 0:
+            level = max(levels, key=lambda level: HISTORY_ROLLUPS[level])
+            width = HISTORY_ROLLUPS[level]
+            # The whole rollup buckets between in_start and in_end, with the readings either side of them
+            # (in rollup buckets that straddle in_start or in_end) read from sensor_history
+            rollup_start = min(in_start + (-in_start) % width, in_end)
+            rollup_end = max(in_end - in_end % width, rollup_start)
+            sql = f"""select SensorId, Time - Time % ? Time, sum(Count) Count
+                        , min(Minimum) Minimum, max(Maximum) Maximum, total(Total) / sum(Count) Average
+                        from (select SensorId, Bucket Time, Count, Minimum, Maximum, Total
+                                from history.sensor_history_{level}
+                                where SensorId in ({sensor_list})
+                                and Bucket >= ? and Bucket < ?
+                            union all
+                            select SensorId, Time, 1, numeric_value(Value), numeric_value(Value), numeric_value(Value)
+                                from history.sensor_history
+                                where SensorId in ({sensor_list})
+                                and Time >= ? and Time < ?
+                                and {NUMERIC_VALUE_SQL}
+                            union all
+                            select SensorId, Time, 1, numeric_value(Value), numeric_value(Value), numeric_value(Value)
+                                from history.sensor_history
+                                where SensorId in ({sensor_list})
+                                and Time >= ? and Time < ?
+                                and {NUMERIC_VALUE_SQL})
+                        group by SensorId, Time - Time % ?
+                        order by SensorId, Time"""
+            parameters = ([in_bucket] + list(in_sensor_ids) + [rollup_start, rollup_end]
+                          + list(in_sensor_ids) + [in_start, rollup_start]
+                          + list(in_sensor_ids) + [rollup_end, in_end] + [in_bucket])
+        else:
+            sql = f"""select SensorId, Time - Time % ? Time, count(*) Count
+                        , min(numeric_value(Value)) Minimum, max(numeric_value(Value)) Maximum
+                        , avg(numeric_value(Value)) Average
+                        from history.sensor_history
+                        where SensorId in ({sensor_list})
+                        and Time >= ? and Time < ?
+                        and {NUMERIC_VALUE_SQL}
+                        group by SensorId, Time - Time % ?
+                        order by SensorId, Time"""
+            parameters = [in_bucket] + list(in_sensor_ids) + [in_start, in_end, in_bucket]
+
+        cursor = self.dbConnection.cursor()
+        cursor.execute(sql, parameters)
+        # Rows are passed on as they are read rather than all being fetched first
+        for row in cursor:
+            yield dict(row)
+        cursor.close()
+
+    def history_maintenance(self, in_retention_days):
+        # Run regularly (see cron/history_maintenance.py)
+        # in_retention_days is how long to keep each of "raw" and the rollup levels - 0 or None keeps them forever
+        self.logger.debug("database history_maintenance %s", in_retention_days)
+
+        self.flush_history()
+
+        # Once only - roll up whatever was recorded before the rollups were maintained
+        cursor = self.dbConnection.cursor()
+        cursor.execute(
+            """select Name, Value
+                from history.sensor_history_rollup""")
+        rollup_state = {row["Name"]: row["Value"] for row in cursor}
+        cursor.close()
+        if "Backfilled" not in rollup_state:
+            self.rollup_history(0, rollup_state["Started"])
+            with self.dbConnection:
+                self.dbConnection.execute(
+                    """insert into history.sensor_history_rollup (Name, Value)
+                        values ('Backfilled', strftime('%s', 'now'))""")
+
+        now = int(time.time())
+        tables = {"raw": ("sensor_history", "Time")}
+        for level in HISTORY_ROLLUPS.keys():
+            tables[level] = (f"sensor_history_{level}", "Bucket")
+
+        deleted = {}
+        for level, (table, time_column) in tables.items():
+            if not in_retention_days.get(level):
+                continue
+            with self.dbConnection:
+                cursor = self.dbConnection.execute(
+                    f"""delete from history.{table}
+                        where {time_column} < ?""",
+                    (now - in_retention_days[level] * 86400,))
+                deleted[level] = cursor.rowcount
+        self.logger.debug("database history_maintenance deleted %s", deleted)
+        return deleted
+
     def find_sensor_by_name(self, inSensorName):
-        self.logger.debug(f"database find_sensor_by_name {inSensorName}")
+        self.logger.debug("database find_sensor_by_name %s", inSensorName)
         cursor = self.dbConnection.cursor()
         cursor.execute(
                 """select SensorName, PublishTopic, SubscribeTopic, MySensorsNodeId, MySensorsSensorId, VariableType, Node.NodeId
@@ -235,7 +959,7 @@ class Database:
         return row
 
     def get_sensor_value_by_name(self, in_sensor_name):
-        self.logger.debug(f"database get_sensor_value_by_name {in_sensor_name}")
+        self.logger.debug("database get_sensor_value_by_name %s", in_sensor_name)
         cursor = self.dbConnection.cursor()
         cursor.execute(
             """select ifnull(CurrentValue, "") as currentvalue
@@ -247,7 +971,7 @@ class Database:
         return row["currentvalue"]
 
     def timed_actions_fired(self, in_day_number, inStartSeconds, inEndSeconds):
-        self.logger.debug(f"database timed_actions_fired {in_day_number} {inStartSeconds}, {inEndSeconds}")
+        self.logger.debug("database timed_actions_fired %s %s, %s", in_day_number, inStartSeconds, inEndSeconds)
         cursor = self.dbConnection.cursor()
         cursor.execute(
                 """select Action.ActionId, Action.SensorName, Action.VariableType, Action.SetValue
@@ -260,8 +984,8 @@ class Database:
                 from TimedTrigger, Action
                 where TimedTrigger.ActionId = Action.ActionId
                 and TimedTrigger.Day in (-1, ?)
-                and to_seconds(Time) between ? and ?
-                order by to_seconds(Time), TimedTrigger.TimedTriggerId
+                and TimedTrigger.Seconds between ? and ?
+                order by TimedTrigger.Seconds, TimedTrigger.TimedTriggerId
                 """,
                 (in_day_number, in_day_number, inStartSeconds, inEndSeconds))
         actions = cursor.fetchall()
@@ -269,19 +993,19 @@ class Database:
         return actions
 
     def nextTriggerTime(self, inSeconds):
-        self.logger.debug(f"database nextTriggerTime {inSeconds}")
+        self.logger.debug("database nextTriggerTime %s", inSeconds)
 
         current_day_of_week = datetime.now().weekday()
 
         cursor = self.dbConnection.cursor()
         # If cannot find anything, return 24 hours (ie max + 1)
         cursor.execute(
-                """select ifnull(min(to_seconds(TimedTrigger.Time)), 86400) as Seconds
+                """select ifnull(min(TimedTrigger.Seconds), 86400) as Seconds
                 from TimedTrigger
-                where to_seconds(TimedTrigger.Time) > ?
+                where TimedTrigger.Seconds > ?
                 and day in (-1, ?)
                 and Status in ("Active", "Once", "Replace")
-                order by to_seconds(TimedTrigger.Time) asc
+                order by TimedTrigger.Seconds asc
                 """,
                 (inSeconds, current_day_of_week))
         seconds = cursor.fetchone()
@@ -289,7 +1013,7 @@ class Database:
         return seconds["Seconds"]
 
     def hp_is_on(self, in_sensor):
-        self.logger.debug(f"database hp_is_on {in_sensor}")
+        self.logger.debug("database hp_is_on %s", in_sensor)
 
         if in_sensor == "HC":
             if int(self.get_sensor_value_by_name("Operating Mode")) == 5:
@@ -303,7 +1027,7 @@ class Database:
             return True
 
     def get_DHW_interval(self, in_day):
-        self.logger.debug(f"database get_DHW_interval {in_day}")
+        self.logger.debug("database get_DHW_interval %s", in_day)
         cursor = self.dbConnection.cursor()
         cursor.execute(
             f"""select Time, SetValue, TimedTriggerId
@@ -312,7 +1036,7 @@ class Database:
                     and SensorName = "DHW"
                     and Status = "External"
                     and TimedTrigger.ActionId = Action.ActionId
-                    order by to_seconds(Time)""",
+                    order by Seconds""",
             (in_day,))
         trigger_times = cursor.fetchall()
         cursor.close()
@@ -321,7 +1045,7 @@ class Database:
 
     # This finds the timed trigger entry for the sensor
     def current_relay_interval(self, in_sensor_name):
-        self.logger.debug(f"database current_relay_interval {in_sensor_name}")
+        self.logger.debug("database current_relay_interval %s", in_sensor_name)
 
         # This handles manual switch - but HC and DHW are not sensors...
         if in_sensor_name in {"HC", "DHW"}:
@@ -332,96 +1056,93 @@ class Database:
         return self.current_relay_interval_value(in_sensor_name, current_value)
 
     def current_relay_interval_value(self, in_sensor_name, in_value):
-        self.logger.debug(f"database current_relay_interval_value {in_sensor_name} {in_value}")
+        self.logger.debug("database current_relay_interval_value %s %s", in_sensor_name, in_value)
 
-        # This is pretty painful when we introduced Once triggers.
-        # It will pick up a Once trigger as a start point (eg, we are currently in a "boost" interval)
-        # and also understand "masking" where a Once on value masks a permanent off value, for instance.
-
-        now = datetime.now()
-        # Monday is zero in both cases
-        current_day_of_week = now.weekday()
-        current_time = now.hour * 60 + now.minute
+        return self.schedule(in_sensor_name).interval(in_value, week_seconds(datetime.now()))
 
+    def schedule_version(self):
         cursor = self.dbConnection.cursor()
-        # Note Once is alphabetically before Active in a descending sort - need to find Once triggers before Active
         cursor.execute(
-            f"""select SetValue
-            , case Day when -1 then {current_day_of_week} else Day end Day
-            , Time
-            , SetValue
-            , Status
-            , TimedTriggerId
-            , TimedTrigger.Description
-            from Action, TimedTrigger
-            where SensorName = ?
-            and TimedTrigger.ActionId = Action.ActionId
-            and TimedTrigger.Status in ("Active", "External", "Once")
-            order by Day, to_seconds(Time), Status desc""",
-            (in_sensor_name, ))
-        trigger_times = cursor.fetchall()
+            """select Value
+            from State
+            where Name = "ScheduleVersion"
+            """)
+        row = cursor.fetchone()
         cursor.close()
+        return row[0]
 
-        # If don't find any, return nothing here
-        if len(trigger_times) == 0:
-            return {}
+    def data_versions(self):
+        # {"Schedule": (version, changed), "Sensor": (version, changed)} with changed in seconds since the epoch
+        # Both move on whenever the programmes / sensor values change (see Schema.DATA_VERSIONS)
+        cursor = self.dbConnection.cursor()
+        cursor.execute(
+            """select Name, Value
+            from State
+            where Name in ("ScheduleVersion", "ScheduleChanged", "SensorVersion")
+            """)
+        state = {row["Name"]: row["Value"] for row in cursor}
+        cursor.close()
 
-        # Prime the previous trigger just in case we are early on Monday morning
-        # - set it to the very last trigger in the week (last on Sunday)
-        return_triggers = {0: trigger_times[len(trigger_times)-1]}
-
-        # This is set when we process a Once trigger that is masking an Active trigger at the same time
-        ignore_next = False
-
-        # This is set if we find a trigger at midnight (23:59:59)
-        # and we need to check if the next trigger switches it back
-        midnight = False
-
-        # Search for today
-        for trigger in trigger_times:
-            # If last switch was 23:59:59 and this is 00:00:00 it must be an external interval over midnight
-            if midnight and trigger["Time"] == "00:00:00":
-                ignore_next = True
-            if trigger["Day"] == current_day_of_week:
-                if current_time < int(trigger["Time"][0:2]) * 60 + int(trigger["Time"][3:5]):
-                    if trigger["SetValue"] != in_value and not ignore_next:
-                        return_triggers[1] = trigger
-                        if not trigger["Time"] == "23:59:59":
-                            return return_triggers
-                    # We have found a masking Once trigger
-                    elif trigger["SetValue"] == in_value and trigger["Status"] == "Once":
-                        ignore_next = True
-                    else:
-                        ignore_next = False
-            elif trigger["Day"] == current_day_of_week + 1:
-                # Moved on to tomorrow
-                if trigger["SetValue"] != in_value and not ignore_next:
-                    return_triggers[1] = trigger
-                    return return_triggers
-                # We have found a masking Once trigger
-                elif trigger["SetValue"] == in_value and trigger["Status"] == "Once":
-                    ignore_next = True
-                else:
-                    ignore_next = False
-            if trigger["Time"] == "23:59:59":
-                midnight = True
-            # Move the prior trigger on if it actually set it to the current value
-            # - or use it anyway if we have come in with a -1 value (just find current interval)
-            if (trigger["SetValue"] == in_value or in_value == -1) and not midnight:
-                return_triggers[0] = trigger
+        # The sensor triggers only count the readings, so the change time is when this process first read the version
+        sensor_version = state["SensorVersion"]
+        seen = _sensor_versions.get(self.database_filename)
+        if seen is None or seen[0] != sensor_version:
+            seen = (sensor_version, int(time.time()))
+            _sensor_versions[self.database_filename] = seen
+
+        return {"Schedule": (state["ScheduleVersion"], int(state["ScheduleChanged"])),
+                "Sensor": seen}
+
+    def schedule(self, in_sensor_name):
+        # The compiled weekly schedule for the sensor, only rebuilt when the triggers have changed
+        return self.schedules([in_sensor_name])[in_sensor_name]
+
+    def schedules(self, in_sensor_names):
+        self.logger.debug("database schedules %s", in_sensor_names)
+
+        version = self.schedule_version()
+        schedules = {}
+        for sensor_name in in_sensor_names:
+            cached = _schedules.get((self.database_filename, sensor_name))
+            if cached is not None and cached[0] == version:
+                schedules[sensor_name] = cached[1]
+
+        # Anything not already compiled at this version is loaded in one go
+        missing = [sensor_name for sensor_name in in_sensor_names if sensor_name not in schedules]
+        if len(missing) > 0:
+            cursor = self.dbConnection.cursor()
+            cursor.execute(
+                f"""select SensorName
+                , Day
+                , Time
+                , Seconds
+                , SetValue
+                , Status
+                , TimedTriggerId
+                , TimedTrigger.Description
+                from Action, TimedTrigger
+                where SensorName in ({",".join("?" * len(missing))})
+                and TimedTrigger.ActionId = Action.ActionId
+                and TimedTrigger.Status in ("Active", "External", "Once")""",
+                missing)
+            sensor_triggers = {sensor_name: [] for sensor_name in missing}
+            for trigger in cursor:
+                sensor_triggers[trigger["SensorName"]].append(trigger)
+            cursor.close()
 
+            for sensor_name, triggers in sensor_triggers.items():
+                schedules[sensor_name] = WeeklySchedule(triggers)
+                _schedules[(self.database_filename, sensor_name)] = (version, schedules[sensor_name])
 
-        # Must be end of Sunday so next trigger is first thing on Monday
-        return_triggers[1] = trigger_times[0]
-        return return_triggers
+        return schedules
 
     def next_relay_switch_time(self, in_sensor_name):
-        self.logger.debug(f"database next_relay_switch_time {in_sensor_name}")
+        self.logger.debug("database next_relay_switch_time %s", in_sensor_name)
 
         return self.current_relay_interval(in_sensor_name)[1]["Time"]
 
     def next_relay_switch_time_value(self, in_sensor_name, in_value):
-        self.logger.debug(f"database next_relay_switch_time_value {in_sensor_name} {in_value}")
+        self.logger.debug("database next_relay_switch_time_value %s %s", in_sensor_name, in_value)
 
         # Might not return anything if there are no intervals for the sensor
         currentInterval = self.current_relay_interval_value(in_sensor_name, in_value)
@@ -432,7 +1153,7 @@ class Database:
     def find_triggers_until(self, in_sensor_name, in_start_time, in_end_time):
         # Find all the triggers against this sensor from start time until the end time is passed
         # Could cross midnight...
-        self.logger.debug(f"database find_triggers_until {in_sensor_name} {in_start_time} {in_end_time}")
+        self.logger.debug("database find_triggers_until %s %s %s", in_sensor_name, in_start_time, in_end_time)
 
         if len(in_start_time) < 8:
             in_start_time += ":00"
@@ -458,8 +1179,8 @@ class Database:
                         where SensorName = ?
                         and TimedTrigger.ActionId = Action.ActionId
                         and Day in (-1, ?)
-                        and to_seconds(Time) between ? and ?
-                        order by to_seconds(Time)""",
+                        and Seconds between ? and ?
+                        order by Seconds""",
                 (in_sensor_name, current_day_of_week, start_seconds, end_seconds))
             trigger_times = cursor.fetchall()
             cursor.close()
@@ -479,23 +1200,23 @@ class Database:
             f"""select SetValue
                         , case Day when -1 then {current_day_of_week} else Day end Day
                         , Time
-                        , to_seconds(Time) seconds
+                        , Seconds
                         from Action, TimedTrigger
                         where SensorName = ?
                         and TimedTrigger.ActionId = Action.ActionId
                         and Day in (-1, ?)
-                        and to_seconds(Time) between ? and 86400
+                        and Seconds between ? and 86400
                 union all
                 select SetValue
                            , case Day when -1 then {tomorrow} else Day end Day
                            , Time
-                           , to_seconds(Time) seconds
+                           , Seconds
                            from Action, TimedTrigger
                            where SensorName = ?
                            and TimedTrigger.ActionId = Action.ActionId
                            and Day in (-1, ?)
-                           and to_seconds(Time) between 0 and ?
-                order by seconds""",
+                           and Seconds between 0 and ?
+                order by Seconds""",
             (in_sensor_name, current_day_of_week, start_seconds, in_sensor_name, tomorrow, end_seconds))
         trigger_times = cursor.fetchall()
         cursor.close()
@@ -504,14 +1225,14 @@ class Database:
 
     def create_once_trigger(self, in_sensor_name, in_day, in_time, in_value):
         # Create a once trigger to set the sensor to the value on the day / time specified
-        self.logger.debug(f"database create_once_trigger {in_sensor_name} {in_day} {in_time} {in_value}")
+        self.logger.debug("database create_once_trigger %s %s %s %s", in_sensor_name, in_day, in_time, in_value)
 
         self.create_trigger(in_sensor_name, in_day, in_time, in_value, "Once", f"{in_sensor_name} Temporary")
 
     def create_replace_trigger(self, in_sensor_name, in_day, in_time, in_timed_trigger_id):
         # Create a Replace trigger to reset the sensor to the regular time
-        self.logger.debug(
-            f"database create_replace_trigger {in_sensor_name} {in_day} {in_time} {in_timed_trigger_id}")
+        self.logger.debug("database create_replace_trigger %s %s %s %s",
+                          in_sensor_name, in_day, in_time, in_timed_trigger_id)
 
         # Find the current time for the trigger
         search_filter = {"TimedTriggerId": in_timed_trigger_id}
@@ -533,7 +1254,7 @@ class Database:
         self.object_create("TimedTrigger", values)
 
     def create_trigger(self, in_sensor_name, in_day, in_time, in_value, in_type, in_description):
-        self.logger.debug(f"database create_trigger {in_sensor_name} {in_day} {in_time} {in_value} {in_type} {in_description}")
+        self.logger.debug("database create_trigger %s %s %s %s %s %s", in_sensor_name, in_day, in_time, in_value, in_type, in_description)
 
         # Find an action that matches
         # TODO - what if there isn't an action!!!
@@ -560,7 +1281,7 @@ class Database:
         self.object_create("TimedTrigger", values)
 
     def delete_once_triggers(self, in_sensor):
-        self.logger.debug(f"database delete_once_triggers {in_sensor}")
+        self.logger.debug("database delete_once_triggers %s", in_sensor)
         cursor = self.dbConnection.cursor()
         cursor.execute(
             """delete from TimedTrigger
@@ -575,7 +1296,7 @@ class Database:
         cursor.close()
 
     def delete_prefixed_triggers(self, in_prefix):
-        self.logger.debug(f"database delete_prefix_triggers {in_prefix}")
+        self.logger.debug("database delete_prefix_triggers %s", in_prefix)
         cursor = self.dbConnection.cursor()
         cursor.execute(
             """delete from TimedTrigger
@@ -587,7 +1308,7 @@ class Database:
 
     def find_replace_triggers(self, in_sensor):
         # TODO implement day of the week!!!
-        self.logger.debug(f"database find_replace_triggers {in_sensor}")
+        self.logger.debug("database find_replace_triggers %s", in_sensor)
         cursor = self.dbConnection.cursor()
         cursor.execute(
                 """select Action.ActionId, Action.SensorName, Action.VariableType, Action.SetValue
@@ -599,7 +1320,7 @@ class Database:
                 where TimedTrigger.ActionId = Action.ActionId
                 and Status = "Replace"
                 and Action.SensorName = ?
-                order by to_seconds(Time), TimedTrigger.TimedTriggerId
+                order by Seconds, TimedTrigger.TimedTriggerId
                 """,
                 (in_sensor, ))
         actions = cursor.fetchall()
@@ -607,27 +1328,50 @@ class Database:
         return actions
 
     def read_prog(self, in_sensor_name):
-        self.logger.debug(f"database read_prog {in_sensor_name}")
+        self.logger.debug("database read_prog %s", in_sensor_name)
+
+        return self.read_progs([in_sensor_name])[in_sensor_name]
+
+    def read_progs(self, in_sensor_names):
+        # The programme for each of the sensors: {sensor name: {day: {interval number: {"Time", "SetValue"}}}}
+        self.logger.debug("database read_progs %s", in_sensor_names)
+
+        # Programmes rarely change so reuse the last one read unless the triggers have changed since
+        # (the results are shared so callers must not modify them)
+        version = self.schedule_version()
+        programmes = {}
+        for sensor_name in in_sensor_names:
+            cached = _programmes.get((self.database_filename, sensor_name))
+            if cached is not None and cached[0] == version:
+                programmes[sensor_name] = cached[1]
+
+        missing = [sensor_name for sensor_name in in_sensor_names if sensor_name not in programmes]
+        if len(missing) == 0:
+            return programmes
 
         cursor = self.dbConnection.cursor()
         # Note that 7 is used as Daily
         cursor.execute(
-            f"""select SetValue
+            f"""select SensorName
+                    , SetValue
                     , case Day when -1 then 7 else Day end Day
                     , Time
                     from Action, TimedTrigger
-                    where SensorName = ?
+                    where SensorName in ({",".join("?" * len(missing))})
                     and TimedTrigger.ActionId = Action.ActionId
                     and TimedTrigger.Status != "Once"
-                    order by Day, to_seconds(Time)""",
-            (in_sensor_name,))
-        trigger_times = cursor.fetchall()
-        cursor.close()
-
-        return_triggers = {}
-        day = -1
-
-        for trigger in trigger_times:
+                    order by SensorName, Day, Seconds""",
+            missing)
+
+        for sensor_name in missing:
+            programmes[sensor_name] = {}
+
+        # Rows arrive grouped by sensor then day, so each is just added to the end of its day
+        return_triggers = None
+        for trigger in cursor:
+            if return_triggers is not programmes[trigger["SensorName"]]:
+                return_triggers = programmes[trigger["SensorName"]]
+                day = -1
             if int(trigger["Day"]) > day:
                 day = int(trigger["Day"])
                 return_triggers[day] = {}
@@ -635,11 +1379,14 @@ class Database:
 
             return_triggers[day][interval_count] = {"Time": trigger["Time"], "SetValue": trigger["SetValue"]}
             interval_count += 1
+        cursor.close()
 
-        return return_triggers
+        for sensor_name in missing:
+            _programmes[(self.database_filename, sensor_name)] = (version, programmes[sensor_name])
+        return programmes
 
     def get_prog_actionids(self, in_sensor):
-        self.logger.debug(f"database get_prog_actionids {in_sensor}")
+        self.logger.debug("database get_prog_actionids %s", in_sensor)
 
         cursor = self.dbConnection.cursor()
         cursor.execute(
@@ -655,7 +1402,7 @@ class Database:
         return {0: actions[0]["actionid"], 1: actions[1]["actionid"]}
 
     def clear_old_timed_triggers(self, in_sensor, in_actionids):
-        self.logger.debug(f"database clear_old_timed_triggers {in_sensor} {in_actionids}")
+        self.logger.debug("database clear_old_timed_triggers %s %s", in_sensor, in_actionids)
 
         cursor = self.dbConnection.cursor()
         cursor.execute(
@@ -666,12 +1413,12 @@ class Database:
         cursor.close()
 
     def update_trigger(self, in_sensor, in_day, in_group, in_value, in_time):
-        self.logger.debug(f"database update_trigger {in_sensor} {in_day} {in_group} {in_value} {in_time}")
+        self.logger.debug("database update_trigger %s %s %s %s %s", in_sensor, in_day, in_group, in_value, in_time)
 
         # Message from UI to modify a timed trigger for one of the programmes
         # TODO Add group as a column to the timedtrigger table to avoid the fuzzy match
 
-        sql = f"""update timedtrigger set time = ?
+        sql = f"""update timedtrigger set time = ?, seconds = ?
                     where timedtriggerid = 
                       (select timedtriggerid from timedtrigger, action
                        where timedtrigger.actionid = action.actionid
@@ -683,12 +1430,12 @@ class Database:
         """
 
         cursor = self.dbConnection.cursor()
-        cursor.execute(sql, (in_time, in_sensor, in_value, in_day))
+        cursor.execute(sql, (in_time, trigger_seconds(in_time), in_sensor, in_value, in_day))
         self.dbConnection.commit()
         cursor.close()
 
     def switch_triggers(self, in_sensor, in_value):
-        self.logger.debug(f"database switch_triggers {in_sensor} {in_value}")
+        self.logger.debug("database switch_triggers %s %s", in_sensor, in_value)
 
         # Update all the ON triggers for a particular sensor to be inactive / active
 
@@ -706,33 +1453,60 @@ class Database:
         cursor.close()
 
     def store_prog(self, in_sensor, in_intervals):
-        self.logger.debug(f"database store_prog {in_sensor} {in_intervals}")
+        # Replaces the sensor's programme in a single transaction
+        # Returns what changed: {"added": [(day, time, "on"/"off"), ...], "removed": [...], "unchanged": count}
+        self.logger.debug("database store_prog %s %s", in_sensor, in_intervals)
 
         days_of_the_week = {0: "Mon", 1: "Tue", 2: "Wed", 3: "Thu", 4: "Fri", 5: "Sat", 6: "Sun"}
 
         actions = self.get_prog_actionids(in_sensor)
-        self.clear_old_timed_triggers(in_sensor, actions)
-
-        values = {"Status": "External"}
+        switch_names = {actions[0]: "off", actions[1]: "on"}
 
+        # Build the whole programme first: (Time, Seconds, ActionId, Description, Day)
+        new_triggers = []
         for day in range(7):
-            values["Day"] = day
             for interval in in_intervals[day].keys():
                 trigger_desc = f"{in_sensor} Prog {days_of_the_week[day]} {interval} "
 
                 if in_intervals[day][interval][0] != "32:00":
-                    values["Description"] = trigger_desc + "on"
-                    values["Time"] = in_intervals[day][interval][0] + ":00"
-                    values["ActionId"] = actions[1]
-                    self.object_create("TimedTrigger", values)
+                    on_time = in_intervals[day][interval][0] + ":00"
+                    off_time = in_intervals[day][interval][1] + ":00"
+                    new_triggers.append((on_time, trigger_seconds(on_time), actions[1], trigger_desc + "on", day))
+                    new_triggers.append((off_time, trigger_seconds(off_time), actions[0], trigger_desc + "off", day))
+
+        cursor = self.dbConnection.cursor()
+        cursor.execute(
+            """select Day, Time, ActionId
+                    from TimedTrigger
+                    where ActionId in (?, ?)
+                    """,
+            (actions[0], actions[1]))
+        old_switches = {(trigger["Day"], trigger["Time"], switch_names[trigger["ActionId"]]) for trigger in cursor}
+        cursor.close()
 
-                    values["Description"] = trigger_desc + "off"
-                    values["Time"] = in_intervals[day][interval][1] + ":00"
-                    values["ActionId"] = actions[0]
-                    self.object_create("TimedTrigger", values)
+        # Either all of it is applied or none of it
+        with self.dbConnection:
+            self.clear_old_timed_triggers(in_sensor, actions)
+            if "timedtrigger" in self.integer_key_tables:
+                self.dbConnection.executemany(
+                    """insert into TimedTrigger (Time, Seconds, ActionId, Description, Day, Status, LastSeen)
+                        values (?, ?, ?, ?, ?, "External", strftime('%s', 'now'))""",
+                    new_triggers)
+            else:
+                next_id = self.getNextId("TimedTrigger")
+                self.dbConnection.executemany(
+                    """insert into TimedTrigger (TimedTriggerId, Time, Seconds, ActionId, Description, Day, Status, LastSeen)
+                        values (?, ?, ?, ?, ?, ?, "External", strftime('%s', 'now'))""",
+                    [(next_id + offset, ) + trigger for offset, trigger in enumerate(new_triggers)])
+
+        new_switches = {(day, trigger_time, switch_names[action_id])
+                        for trigger_time, seconds, action_id, description, day in new_triggers}
+        return {"added": sorted(new_switches - old_switches),
+                "removed": sorted(old_switches - new_switches),
+                "unchanged": len(new_switches & old_switches)}
 
     def read_all_sensors(self):
-        self.logger.debug(f"database read_all_sensors")
+        self.logger.debug("database read_all_sensors")
 
         cursor = self.dbConnection.cursor()
         cursor.execute(
@@ -748,8 +1522,40 @@ class Database:
 
         return sensor_dict
 
+    def dashboard_snapshot(self):
+        # Everything the dashboard shows: all sensor values plus the on / off state and next switch
+        # time of each relay, from the shared compiled schedules rather than a query per relay
+        self.logger.debug("database dashboard_snapshot")
+
+        sensors = self.read_all_sensors()
+
+        now = week_seconds(datetime.now())
+        relay_schedules = self.schedules(list(DASHBOARD_RELAYS.keys()))
+
+        for relay_name, title in DASHBOARD_RELAYS.items():
+            # As current_relay_interval - HC and DHW just find the current interval
+            if relay_name in {"HC", "DHW"}:
+                current_value = -1
+            else:
+                current_value = sensors.get(relay_name, "")
+
+            interval = relay_schedules[relay_name].interval(current_value, now)
+            if len(interval) == 0:
+                sensors[f"{title} next switch"] = ""
+            else:
+                sensors[f"{title} next switch"] = interval[1]["Time"][0:5]
+
+            if relay_name in {"HC", "DHW"}:
+                # As hp_is_on
+                if relay_name == "HC" and int(sensors["Operating Mode"]) == 5:
+                    sensors[f"{title} is on"] = False
+                else:
+                    sensors[f"{title} is on"] = len(interval) > 0 and interval[0]["SetValue"] != "0"
+
+        return sensors
+
     def read_savingsession(self):
-        self.logger.debug(f"database read_savingsession")
+        self.logger.debug("database read_savingsession")
 
         cursor = self.dbConnection.cursor()
         cursor.execute(
@@ -770,3 +1576,21 @@ class Database:
             return {"dayofweek": times[0]["Day"], "starttime": times[0]["Time"], "endtime": times[1]["Time"]}
         else:
             return {}
+
+    def read_savingsession_changed(self, in_previous, in_timeout):
+        # Read the saving session once it differs from in_previous, ie. once a pending change has been
+        # applied by the controller - or whatever is there when the timeout is reached
+        self.logger.debug("database read_savingsession_changed %s %s", in_previous, in_timeout)
+
+        deadline = time.monotonic() + in_timeout
+        data_version = self.data_version()
+        session = self.read_savingsession()
+        while session == in_previous:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.wait_for_change(data_version, remaining)
+            data_version = self.data_version()
+            session = self.read_savingsession()
+
+        return session
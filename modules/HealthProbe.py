@@ -0,0 +1,92 @@
+
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import Instrument
+
+
+class HealthProbe:
+    # Runs the service checks (systemctl, ISG, MyController) on a background timer, all in parallel,
+    # and caches their output so that page renders never wait for them (the MyController check is an ssh)
+
+    def __init__(self, in_probes, in_interval, in_ttl, in_timeout, inLogger):
+        self.logger = inLogger
+        self.logger.debug("healthprobe __init__ %s %s %s %s", in_probes, in_interval, in_ttl, in_timeout)
+
+        # Name -> command to run, the command's output is the status (eg. "active")
+        self.probes = in_probes
+        self.interval = in_interval
+        self.ttl = in_ttl
+        self.timeout = in_timeout
+
+        self.lock = threading.Lock()
+        self.results = {name: {"status": "", "checked": None, "state": "pending"} for name in in_probes}
+
+        self.stop_event = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=len(in_probes), thread_name_prefix="healthprobe")
+        self.thread = threading.Thread(target=self.run, name="healthprobe", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.executor.shutdown(wait=False)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.check_all()
+            except Exception as error:
+                # Keep checking - otherwise every service shows stale until web2py restarts
+                self.logger.error("healthprobe check_all failed %r", error)
+            self.stop_event.wait(self.interval)
+
+    def check_all(self):
+        # Waits for all of them, but each one is bounded by the timeout
+        list(self.executor.map(self.check, self.probes.keys()))
+
+    def check(self, in_name):
+        try:
+            with Instrument.timed(f"healthprobe {in_name}"):
+                process = subprocess.run(self.probes[in_name],
+                                         stdout=subprocess.PIPE,
+                                         universal_newlines=True,
+                                         timeout=self.timeout)
+            result = {"status": process.stdout, "state": "ok"}
+        except subprocess.TimeoutExpired:
+            self.logger.debug("healthprobe check %s timed out after %s", in_name, self.timeout)
+            result = {"status": "timeout", "state": "timeout"}
+        except Exception as error:
+            # Anything else (eg. output that is not valid text) is recorded rather than killing the loop
+            self.logger.debug("healthprobe check %s failed %r", in_name, error)
+            result = {"status": str(error), "state": "error"}
+
+        result["checked"] = time.time()
+        with self.lock:
+            self.results[in_name] = result
+
+    def status(self, in_name):
+        # Returns the last result - marked stale if the probes have not run within the ttl
+        with self.lock:
+            result = dict(self.results[in_name])
+
+        if result["checked"] is not None and time.time() - result["checked"] > self.ttl:
+            result["state"] = "stale"
+        return result
+
+
+# One set of probes per process, kept when the module is reloaded (the web2py controller reloads it)
+_monitor = globals().get("_monitor")
+_monitor_lock = globals().get("_monitor_lock", threading.Lock())
+
+
+def get_monitor(in_probes, in_interval, in_ttl, in_timeout, inLogger):
+    global _monitor
+    with _monitor_lock:
+        if _monitor is None:
+            _monitor = HealthProbe(in_probes, in_interval, in_ttl, in_timeout, inLogger)
+            _monitor.start()
+        return _monitor
@@ -0,0 +1,144 @@
+
+import functools
+import threading
+import time
+import types
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+# Upper bounds (milliseconds) of the latency histogram buckets, anything slower goes in the last one
+HISTOGRAM_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# Timings for the whole process, kept when the module is reloaded (the web2py controller reloads it)
+# Off unless enable() is called, when off the instrumented calls cost one flag check
+_enabled = globals().get("_enabled", False)
+_timings = globals().get("_timings", {})
+_timings_lock = globals().get("_timings_lock", threading.Lock())
+
+
+def enable(in_enabled=True):
+    global _enabled
+    _enabled = bool(in_enabled)
+
+
+def enabled():
+    return _enabled
+
+
+def record(in_name, in_seconds, in_rows=None, in_error=False):
+    with _timings_lock:
+        timing = _timings.get(in_name)
+        if timing is None:
+            timing = {"calls": 0, "errors": 0, "rows": 0, "seconds": 0.0, "max_seconds": 0.0,
+                      "histogram": [0] * (len(HISTOGRAM_MS) + 1)}
+            _timings[in_name] = timing
+        timing["calls"] += 1
+        if in_error:
+            timing["errors"] += 1
+        if in_rows is not None:
+            timing["rows"] += in_rows
+        timing["seconds"] += in_seconds
+        timing["max_seconds"] = max(timing["max_seconds"], in_seconds)
+        timing["histogram"][bisect_left(HISTOGRAM_MS, in_seconds * 1000)] += 1
+
+
+def histogram_labels():
+    return [f"<={bound}ms" for bound in HISTOGRAM_MS] + [f">{HISTOGRAM_MS[-1]}ms"]
+
+
+def stats():
+    # {name: {"calls", "errors", "rows", "total_ms", "mean_ms", "max_ms", "histogram": {"<=1ms": count, ...}}}
+    labels = histogram_labels()
+    with _timings_lock:
+        return {name: {"calls": timing["calls"],
+                       "errors": timing["errors"],
+                       "rows": timing["rows"],
+                       "total_ms": round(timing["seconds"] * 1000, 3),
+                       "mean_ms": round(timing["seconds"] * 1000 / timing["calls"], 3),
+                       "max_ms": round(timing["max_seconds"] * 1000, 3),
+                       "histogram": dict(zip(labels, timing["histogram"]))}
+                for name, timing in sorted(_timings.items())}
+
+
+def reset():
+    with _timings_lock:
+        _timings.clear()
+
+
+class Timing:
+    # What timed() hands to the block being timed, which can set the number of rows it dealt with
+    def __init__(self):
+        self.rows = None
+
+
+@contextmanager
+def timed(in_name, in_not_errors=()):
+    # with timed("name") as timing: ... (timing.rows = n)
+    # Exceptions in in_not_errors (eg. web2py's HTTP for a redirect) are not counted as errors
+    if not _enabled:
+        yield Timing()
+        return
+
+    timing = Timing()
+    started = time.perf_counter()
+    try:
+        yield timing
+    except BaseException as error:
+        record(in_name, time.perf_counter() - started, timing.rows, not isinstance(error, in_not_errors))
+        raise
+    record(in_name, time.perf_counter() - started, timing.rows)
+
+
+def row_count(in_result):
+    # Lists of rows and dicts keyed by name - a single row or value is not counted
+    if isinstance(in_result, (list, dict)):
+        return len(in_result)
+    return None
+
+
+def timed_generator(in_name, in_generator, in_started):
+    # A generator's work is done as it is read, so the timing runs until it is exhausted (or abandoned)
+    rows = 0
+    error = False
+    try:
+        for row in in_generator:
+            rows += 1
+            yield row
+    except BaseException:
+        error = True
+        raise
+    finally:
+        record(in_name, time.perf_counter() - in_started, rows, error)
+
+
+def instrumented(in_name):
+    # Decorator recording the calls, latency and (for list / dict results) rows of a function
+    def decorator(in_function):
+        @functools.wraps(in_function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return in_function(*args, **kwargs)
+
+            started = time.perf_counter()
+            try:
+                result = in_function(*args, **kwargs)
+            except BaseException:
+                record(in_name, time.perf_counter() - started, None, True)
+                raise
+            if isinstance(result, types.GeneratorType):
+                return timed_generator(in_name, result, started)
+            record(in_name, time.perf_counter() - started, row_count(result))
+            return result
+        return wrapper
+    return decorator
+
+
+def instrument_methods(in_prefix):
+    # Class decorator applying instrumented() to every public method, recorded as "<in_prefix> <method>"
+    def decorator(in_class):
+        for name, value in list(vars(in_class).items()):
+            if not name.startswith("_") and isinstance(value, types.FunctionType):
+                setattr(in_class, name, instrumented(f"{in_prefix} {name}")(value))
+        return in_class
+    return decorator
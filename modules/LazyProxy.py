@@ -0,0 +1,69 @@
+
+import datetime
+import functools
+
+
+class LazyProxy:
+    # Stands in for an object that is only built (by in_factory) when something first uses it, so that
+    # requests which never touch it (eg. the dashboard and Auth) do not pay for building it
+
+    def __init__(self, in_factory):
+        object.__setattr__(self, "_factory", in_factory)
+        object.__setattr__(self, "_target", None)
+
+    def resolve(self):
+        if self._target is None:
+            object.__setattr__(self, "_target", self._factory())
+        return self._target
+
+    def resolved(self):
+        return self._target is not None
+
+    def __getattr__(self, in_name):
+        return getattr(self.resolve(), in_name)
+
+    def __setattr__(self, in_name, in_value):
+        setattr(self.resolve(), in_name, in_value)
+
+    def __call__(self, *in_args, **in_kwargs):
+        return self.resolve()(*in_args, **in_kwargs)
+
+
+class LazyAuth(LazyProxy):
+    # A LazyProxy for web2py's Auth that can also answer auth.user (for the layout's menu) from the
+    # session and apply the @auth.requires_... decorators without building Auth until the action runs
+
+    def __init__(self, in_factory, in_session, in_now):
+        super().__init__(in_factory)
+        object.__setattr__(self, "_session", in_session)
+        object.__setattr__(self, "_now", in_now)
+
+    @property
+    def user(self):
+        if self._target is not None:
+            return self._target.user
+
+        # As Auth.__init__, which also tidies up an expired session when it is built
+        session_auth = self._session.auth
+        if not session_auth or not session_auth.last_visit:
+            return None
+        if session_auth.last_visit + datetime.timedelta(seconds=session_auth.expiration) <= self._now:
+            return None
+        # Keep the session alive while the pages that do not need Auth are being used
+        if (self._now - session_auth.last_visit).seconds > session_auth.expiration // 10:
+            session_auth.last_visit = self._now
+        return session_auth.user
+
+    def __getattr__(self, in_name):
+        if in_name.startswith("requires") and self._target is None:
+            return functools.partial(self.lazy_requires, in_name)
+        return super().__getattr__(in_name)
+
+    def lazy_requires(self, in_name, *in_args, **in_kwargs):
+        # The decorators are applied every time the controller runs, the check is made when the action is called
+        def decorator(in_action):
+            @functools.wraps(in_action)
+            def wrapper(*args, **kwargs):
+                return getattr(self.resolve(), in_name)(*in_args, **in_kwargs)(in_action)(*args, **kwargs)
+            return wrapper
+        return decorator
@@ -0,0 +1,26 @@
+import threading
+import time
+
+
+# The dashboard values each live version stood for, so that dashboardchanges can send just what has
+# changed since the browser's version - {version: (expires, values)}, kept when the module is reloaded
+_versions = globals().get("_versions", {})
+_versions_lock = globals().get("_versions_lock", threading.Lock())
+
+
+def remember(in_version, in_values, in_expire):
+    # Keeps in_values under in_version for in_expire seconds from now (from the last time it is remembered)
+    now = time.monotonic()
+    with _versions_lock:
+        for version in [version for version, (expires, values) in _versions.items() if expires <= now]:
+            del _versions[version]
+        _versions[in_version] = (now + in_expire, in_values)
+
+
+def recall(in_version):
+    # The values remembered under in_version or None if they have expired (or were never remembered)
+    with _versions_lock:
+        remembered = _versions.get(in_version)
+    if remembered is None or remembered[0] <= time.monotonic():
+        return None
+    return remembered[1]
@@ -0,0 +1,118 @@
+
+import concurrent.futures
+import queue
+import threading
+import time
+
+import Instrument
+
+
+class Publisher:
+    # One long lived Message (MQTT client) shared by every web2py request, so that switching a relay
+    # costs a publish rather than a new connection and MQTT handshake.
+    # Publishes are queued and sent in order by a single worker thread, which owns the Message.
+
+    def __init__(self, in_message_factory, in_publish_timeout, inLogger):
+        self.logger = inLogger
+        self.logger.debug("publisher __init__ %s", in_publish_timeout)
+
+        # Called to (re)connect - returns a new Message
+        self.message_factory = in_message_factory
+        self.publish_timeout = in_publish_timeout
+        self.message = None
+
+        self.outbound = queue.Queue()
+
+        self.thread = threading.Thread(target=self.run, name="publisher", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    @Instrument.instrumented("publisher publish")
+    def publish(self, in_method, *in_args):
+        # Queue a call to one of the Message set_..._control methods and wait for its result
+        # The result is whatever Message returns (the MQTT (rc, mid) for the publish, a paho MQTTMessageInfo),
+        # only once the broker has acknowledged it - raises TimeoutError if that does not happen in time
+        self.logger.debug("publisher publish %s %s", in_method, in_args)
+        future = concurrent.futures.Future()
+        self.outbound.put((in_method, in_args, future, time.monotonic() + self.publish_timeout))
+        try:
+            return future.result(timeout=self.publish_timeout)
+        except concurrent.futures.TimeoutError:
+            # The caller has been told it failed, so it must not be sent later (unless it is already being sent)
+            future.cancel()
+            raise
+
+    def queue_depth(self):
+        return self.outbound.qsize()
+
+    def run(self):
+        while True:
+            method, args, future, deadline = self.outbound.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = self.send(method, args)
+                self.wait_for_acknowledgement(method, result, deadline)
+                future.set_result(result)
+            except Exception as error:
+                future.set_exception(error)
+
+    def wait_for_acknowledgement(self, in_method, in_result, in_deadline):
+        # The publish has only been queued on the client - with QoS > 0 wait for the broker's PUBACK / PUBCOMP
+        # (received by the Message's network loop). QoS 0 publishes count as published once they are sent
+        if in_result[0] != 0 or not hasattr(in_result, "wait_for_publish"):
+            return
+        in_result.wait_for_publish(max(in_deadline - time.monotonic(), 0))
+        if not in_result.is_published():
+            self.logger.debug("publisher send %s mid %s not acknowledged", in_method, in_result[1])
+            raise TimeoutError(f"{in_method} was not acknowledged by the broker")
+
+    def send(self, in_method, in_args):
+        # Try once on the existing connection, then once more on a fresh one
+        for attempt in range(2):
+            try:
+                if self.message is None:
+                    self.connect()
+                result = getattr(self.message, in_method)(*in_args)
+            except OSError as error:
+                self.logger.debug("publisher send %s failed %s", in_method, error)
+                self.disconnect()
+                if attempt > 0:
+                    raise
+                continue
+
+            # Non zero rc is typically MQTT_ERR_NO_CONN after the broker dropped us
+            if result[0] != 0 and attempt == 0:
+                self.logger.debug("publisher send %s rc %s, reconnecting", in_method, result[0])
+                self.disconnect()
+                continue
+
+            return result
+
+    @Instrument.instrumented("publisher connect")
+    def connect(self):
+        self.logger.debug("publisher connect")
+        self.message = self.message_factory()
+
+    def disconnect(self):
+        if self.message is not None and hasattr(self.message, "disconnect"):
+            try:
+                self.message.disconnect()
+            except Exception as error:
+                self.logger.debug("publisher disconnect failed %s", error)
+        self.message = None
+
+
+# One publisher per process, kept when the module is reloaded (the web2py controller reloads it)
+_publisher = globals().get("_publisher")
+_publisher_lock = globals().get("_publisher_lock", threading.Lock())
+
+
+def get_publisher(in_message_factory, in_publish_timeout, inLogger):
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            _publisher = Publisher(in_message_factory, in_publish_timeout, inLogger)
+            _publisher.start()
+        return _publisher
@@ -0,0 +1,52 @@
+
+import atexit
+import itertools
+import logging
+import logging.handlers
+import queue
+import threading
+
+
+# Log records are queued by the thread that logs them and written to the file by a single
+# listener thread, so logging never waits for the disk.
+# One listener per log file per process, kept when the module is reloaded (the web2py controller reloads it)
+_listeners = globals().get("_listeners", {})
+_listeners_lock = globals().get("_listeners_lock", threading.Lock())
+
+
+def get_logger(in_name, in_filename, in_level):
+    # The named logger, writing to in_filename through the queue at in_level (eg. "INFO" or logging.INFO)
+    # Safe to call on every request - only the level is changed once it has been set up
+    logger = logging.getLogger(in_name)
+    logger.setLevel(in_level)
+
+    with _listeners_lock:
+        if in_name not in _listeners:
+            file_handler = logging.FileHandler(in_filename)
+            file_handler.setFormatter(logging.Formatter("%(asctime)s:%(levelname)s: %(message)s"))
+
+            records = queue.SimpleQueue()
+            listener = logging.handlers.QueueListener(records, file_handler)
+            listener.start()
+            # Write out whatever is still queued when the process exits
+            atexit.register(listener.stop)
+
+            logger.addHandler(logging.handlers.QueueHandler(records))
+            _listeners[in_name] = listener
+
+    return logger
+
+
+class SampledLogger:
+    # Logs one call in every in_every, for code that runs for every MQTT message where logging
+    # each call would be more work than the call itself. Nothing at all is done unless DEBUG is on
+
+    def __init__(self, inLogger, in_every):
+        self.logger = inLogger
+        self.every = in_every
+        # next() on a count is atomic, so this can be shared between threads
+        self.calls = itertools.count()
+
+    def debug(self, in_message, *in_args):
+        if self.logger.isEnabledFor(logging.DEBUG) and next(self.calls) % self.every == 0:
+            self.logger.debug(in_message + f" (1 in {self.every})", *in_args)
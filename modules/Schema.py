@@ -0,0 +1,476 @@
+# The controller database schema: migrations, the indexes behind the hot queries and a check of their query plans
+
+import logging
+import os.path
+import re
+import sqlite3
+import sys
+import tempfile
+
+
+# SQL equivalent of trigger_seconds() so that SQLite can maintain the column without a Python callback
+def seconds_sql(in_column):
+    return f"""((cast(substr({in_column}, 1, 2) as integer) * 60
+                + cast(substr({in_column}, 4, 2) as integer)) * 60
+                + cast(substr({in_column}, 7, 2) as integer))"""
+
+
+# Rolled up sensor history: table suffix (history.sensor_history_<level>) and bucket width in seconds
+HISTORY_ROLLUPS = {"minute": 60, "hour": 3600, "day": 86400}
+
+
+# Tables whose <Table>Id column should be an INTEGER PRIMARY KEY
+INTEGER_KEY_TABLES = ("Node", "Sensor", "Action", "TimedTrigger")
+
+
+# True if the table's <Table>Id column is an alias for the rowid, so SQLite allocates it
+def has_integer_key(in_connection, in_table):
+    columns = in_connection.execute(f"pragma table_info({in_table})").fetchall()
+    key_columns = [column for column in columns if column["pk"] > 0]
+    return len(key_columns) == 1 \
+        and key_columns[0]["name"].lower() == f"{in_table}Id".lower() \
+        and key_columns[0]["type"].upper() == "INTEGER"
+
+
+# Splits a create table column list on the commas that are not inside brackets or quotes
+def split_definitions(in_definitions):
+    definitions = []
+    depth = 0
+    quote = None
+    start = 0
+    for position, character in enumerate(in_definitions):
+        if quote is not None:
+            if character == quote:
+                quote = None
+        elif character in "'\"`[":
+            quote = "]" if character == "[" else character
+        elif character == "(":
+            depth += 1
+        elif character == ")":
+            depth -= 1
+        elif character == "," and depth == 0:
+            definitions.append(in_definitions[start:position].strip())
+            start = position + 1
+    definitions.append(in_definitions[start:].strip())
+    return definitions
+
+
+# The column (or constraint) name a definition starts with, quoted or not
+DEFINITION_NAME = re.compile(r"""\s*(?:"([^"]+)"|`([^`]+)`|\[([^\]]+)\]|(\w+))""")
+
+
+def definition_name(in_definition):
+    match = DEFINITION_NAME.match(in_definition)
+    return next(name for name in match.groups() if name is not None).lower()
+
+
+# Rebuilds the table from its original create table with only <Table>Id changed to INTEGER PRIMARY KEY,
+# so every other column definition and constraint is kept, then puts back its indexes and triggers
+def migrate_integer_key(in_connection, in_table):
+    if has_integer_key(in_connection, in_table):
+        return
+
+    key_column = f"{in_table}Id".lower()
+    duplicate = in_connection.execute(
+        f"""select {key_column} from {in_table}
+            group by {key_column} having count(*) > 1""").fetchone()
+    if duplicate is not None:
+        # Left for someone to sort out by hand - object_create keeps using max(id) + 1 for this table
+        return
+
+    table_sql = in_connection.execute(
+        "select sql from sqlite_master where type = 'table' and name = ?", (in_table,)).fetchone()[0]
+    opening = table_sql.index("(")
+    definitions = []
+    for definition in split_definitions(table_sql[opening + 1:table_sql.rindex(")")]):
+        name = definition_name(definition)
+        if name == key_column:
+            # Keep the name as it was written, the rest of its definition goes
+            definition = f"{DEFINITION_NAME.match(definition).group(0)} integer primary key"
+        elif name == "primary" or (name == "constraint" and re.search(r"\bprimary\s+key\b", definition, re.I)):
+            key = re.search(r"\bprimary\s+key\s*\((.*)\)", definition, re.I | re.S)
+            if [definition_name(column) for column in split_definitions(key.group(1))] != [key_column]:
+                # A key over other columns as well - not something to change automatically
+                return
+            continue
+        definitions.append(definition)
+    rebuild_sql = f"create table {in_table}_rebuild ({', '.join(definitions)}){table_sql[table_sql.rindex(')') + 1:]}"
+
+    # Indexes made by unique / primary key constraints have no sql and come back with the table
+    dependents = in_connection.execute(
+        """select sql from sqlite_master
+            where tbl_name = ? and type in ('index', 'trigger') and sql is not null
+            order by type""",
+        (in_table,)).fetchall()
+    column_names = ", ".join(row["name"] for row in in_connection.execute(f"pragma table_info({in_table})"))
+
+    # Without legacy_alter_table the rename re-checks every view and trigger, which fails on
+    # any that refer to this table while it does not exist
+    legacy_alter_table = in_connection.execute("pragma legacy_alter_table").fetchone()[0]
+    in_connection.execute("pragma legacy_alter_table = on")
+    try:
+        with in_connection:
+            if not in_connection.in_transaction:
+                in_connection.execute("begin")
+            in_connection.execute(rebuild_sql)
+            in_connection.execute(
+                f"""insert into {in_table}_rebuild ({column_names})
+                    select {column_names} from {in_table}""")
+            in_connection.execute(f"drop table {in_table}")
+            in_connection.execute(f"alter table {in_table}_rebuild rename to {in_table}")
+            for dependent in dependents:
+                in_connection.execute(dependent["sql"])
+    finally:
+        in_connection.execute(f"pragma legacy_alter_table = {legacy_alter_table}")
+
+
+# Indexes backing the hot queries in Database: (name, table, columns)
+# Where the query only needs a few columns they are all in the index so the table itself is never read
+INDEXES = (
+    # gatewayFindFromSubscribeTopic - every MQTT message
+    ("GatewaySubscribeTopic", "Gateway", "SubscribeTopic"),
+    # find_sensor_by_name joins back to the gateway
+    ("GatewayGatewayId", "Gateway", "GatewayId"),
+    # nodeFindFromMyNode - select max(NodeId)
+    ("NodeGatewayMySensorsNode", "Node", "GatewayId, MySensorsNodeId, NodeId"),
+    # sensorFindFromMySensor - select max(SensorId)
+    ("SensorNodeMySensorsSensor", "Sensor", "NodeId, MySensorsSensorId, SensorId"),
+    # get_sensor_value_by_name, find_sensor_by_name - not covering as CurrentValue is written for every reading
+    ("SensorSensorName", "Sensor", "SensorName"),
+    # Every join from a sensor to its triggers starts here, create_trigger and get_prog_actionids stop here
+    ("ActionSensorNameSetValue", "Action", "SensorName, SetValue, ActionId"),
+    # ... and continues here
+    ("TimedTriggerActionIdStatus", "TimedTrigger", "ActionId, Status"),
+    # timed_actions_fired, nextTriggerTime - every tick of the controller
+    ("TimedTriggerDaySecondsStatus", "TimedTrigger", "Day, Seconds, Status"),
+    # getLastSeconds, schedule_version
+    ("StateName", "State", "Name"),
+)
+
+
+def create_indexes(in_connection):
+    for name, table, columns in INDEXES:
+        # An index created by an earlier version with different columns is replaced
+        existing = [row["name"] for row in in_connection.execute(f"pragma index_info({name})")]
+        if existing and existing != [column.strip() for column in columns.split(",")]:
+            in_connection.execute(f"drop index {name}")
+        in_connection.execute(f"create index if not exists {name} on {table} ({columns})")
+
+
+# State rows counting the changes to some of the tables, whoever changes them, along with when they last changed.
+# ScheduleVersion tells the compiled schedules and cached programmes when to reload and the JSON API
+# uses the versions for its ETag / Last-Modified headers.
+# The sensors change on every reading so only their version row is written (Database.data_versions
+# works out when it moved on), rather than a second State row for each reading
+# Name: (tables, the column an update has to change or None for any update, whether <Name>Changed is kept)
+DATA_VERSIONS = {"Schedule": (("TimedTrigger", "Action"), None, True),
+                 "Sensor": (("Sensor",), "CurrentValue", False)}
+
+
+def create_data_versions(in_connection):
+    for name, (tables, column, changed) in DATA_VERSIONS.items():
+        in_connection.execute(
+            f"""insert into State (Name, Value)
+                select '{name}Version', 0
+                where not exists (select 1 from State where Name = '{name}Version')""")
+        if changed:
+            in_connection.execute(
+                f"""insert into State (Name, Value)
+                    select '{name}Changed', strftime('%s', 'now')
+                    where not exists (select 1 from State where Name = '{name}Changed')""")
+            update_sql = f"""update State
+                            set Value = case Name when '{name}Version' then Value + 1 else strftime('%s', 'now') end
+                            where Name in ('{name}Version', '{name}Changed');"""
+        else:
+            in_connection.execute(f"delete from State where Name = '{name}Changed'")
+            update_sql = f"update State set Value = Value + 1 where Name = '{name}Version';"
+
+        for table in tables:
+            for event in ("insert", "update", "delete"):
+                trigger = f"{table}{name}Version{event.capitalize()}"
+                if event == "update" and column is not None:
+                    event_sql = f"update of {column} on {table} when new.{column} is not old.{column}"
+                else:
+                    event_sql = f"{event} on {table}"
+
+                # Earlier versions of these triggers only counted the changes, or always kept <Name>Changed
+                existing = in_connection.execute(
+                    "select sql from sqlite_master where type = 'trigger' and name = ?", (trigger,)).fetchone()
+                if existing is not None and (f"{name}Changed" in existing["sql"]) != changed:
+                    in_connection.execute(f"drop trigger {trigger}")
+
+                in_connection.execute(
+                    f"""create trigger if not exists {trigger}
+                        after {event_sql}
+                        begin
+                            {update_sql}
+                        end""")
+
+
+# Bumped whenever migrate_schema gains a step - stored in State as SchemaVersion by migrate_schema
+SCHEMA_VERSION = 2
+
+
+class SchemaOutOfDate(Exception):
+    pass
+
+
+def schema_version(in_connection):
+    row = in_connection.execute("select Value from State where Name = 'SchemaVersion'").fetchone()
+    return int(row[0]) if row is not None else 0
+
+
+# Connections never migrate the database themselves (web2py's are read only and the rebuilds are not
+# something to do under the running controller) - raises SchemaOutOfDate if migrate_database is needed
+def check_schema(in_connection, inDatabaseFilename):
+    if schema_version(in_connection) < SCHEMA_VERSION:
+        raise SchemaOutOfDate(f"{inDatabaseFilename} needs migrating - stop the controller and web2py and run "
+                              f"python modules/Schema.py --migrate {inDatabaseFilename}")
+
+
+# Brings an existing controller database up to the schema this module expects.
+# Each step checks what is already there so it is safe to run against any version of the database
+def migrate_schema(in_connection):
+    # Ids are allocated by SQLite (the key column becomes an alias for the rowid) rather than max(id) + 1
+    for table in INTEGER_KEY_TABLES:
+        migrate_integer_key(in_connection, table)
+
+    # TimedTrigger.Seconds materialises the trigger time as seconds of the day so that the
+    # trigger lookups can use an index rather than calling to_seconds() for every row
+    columns = [column["name"] for column in in_connection.execute("pragma table_info(TimedTrigger)")]
+    if "Seconds" not in columns:
+        in_connection.execute("alter table TimedTrigger add column Seconds integer")
+    in_connection.execute(f"update TimedTrigger set Seconds = {seconds_sql('Time')} where Seconds is null")
+
+    # Database keeps Seconds up to date itself, these catch any other writer that only sets Time
+    in_connection.execute(
+        f"""create trigger if not exists TimedTriggerSecondsInsert
+            after insert on TimedTrigger
+            when new.Seconds is null
+            begin
+                update TimedTrigger set Seconds = {seconds_sql('new.Time')} where rowid = new.rowid;
+            end""")
+    in_connection.execute(
+        f"""create trigger if not exists TimedTriggerSecondsUpdate
+            after update of Time on TimedTrigger
+            when new.Seconds is old.Seconds and new.Time is not old.Time
+            begin
+                update TimedTrigger set Seconds = {seconds_sql('new.Time')} where rowid = new.rowid;
+            end""")
+
+    # Minute, hour and day min / max / average of the sensor history, maintained as readings are written
+    for level in HISTORY_ROLLUPS.keys():
+        in_connection.execute(
+            f"""create table if not exists history.sensor_history_{level} (
+                SensorId integer,
+                Bucket integer,
+                Count integer,
+                Minimum real,
+                Maximum real,
+                Total real,
+                primary key (SensorId, Bucket))""")
+    in_connection.execute(
+        """create index if not exists history.SensorHistorySensorTime
+            on sensor_history (SensorId, Time)""")
+    # Readings from before the rollups existed are rolled up by history_maintenance()
+    in_connection.execute(
+        """create table if not exists history.sensor_history_rollup (
+            Name text primary key,
+            Value integer)""")
+    in_connection.execute(
+        """insert or ignore into history.sensor_history_rollup (Name, Value)
+            values ('Started', strftime('%s', 'now'))""")
+
+    # <Name>Version (and <Name>Changed) in State (see DATA_VERSIONS)
+    create_data_versions(in_connection)
+
+    # Indexes for the lookups made on every MQTT message and page view (see INDEXES)
+    create_indexes(in_connection)
+
+    in_connection.execute("delete from State where Name = 'SchemaVersion'")
+    in_connection.execute("insert into State (Name, Value) values ('SchemaVersion', ?)", (SCHEMA_VERSION,))
+    in_connection.commit()
+
+
+def migrate_database(inDatabaseFilename, inLogger):
+    # The explicit migration step, also switches the database to WAL
+    # Returns the journal modes of the main and history databases, which should both be wal
+    import Database
+
+    connection = Database.connect(inDatabaseFilename, inLogger, in_check_schema=False)
+    migrate_schema(connection)
+    modes = [connection.execute(f"pragma {schema}.journal_mode").fetchone()[0] for schema in ("main", "history")]
+    connection.close()
+    return modes
+
+
+# Database methods run by check_query_plans() with the arguments to call them with
+# The arguments only need to be plausible, the query plans do not depend on the data
+HOT_QUERIES = (
+    ("gatewayFindFromSubscribeTopic", ("mysensors-out",)),
+    ("nodeFindFromMyNode", (1, 1)),
+    ("sensorFindFromMySensor", (1, 1)),
+    ("get_sensor_value_by_name", ("Operating Mode",)),
+    ("find_sensor_by_name", ("DHW",)),
+    ("getLastSeconds", ()),
+    ("schedule_version", ()),
+    ("data_versions", ()),
+    ("sensor_change_token", ("Radiators relay",)),
+    ("timed_actions_fired", (0, 0, 60)),
+    ("nextTriggerTime", (0,)),
+    ("get_DHW_interval", (0,)),
+    ("schedules", (["DHW", "HC", "Radiators relay"],)),
+    ("read_progs", (["DHW", "HC", "Radiators relay"],)),
+    ("find_triggers_until", ("DHW", "06:00", "09:00")),
+    ("find_triggers_until", ("DHW", "23:00", "01:00")),
+    ("find_replace_triggers", ("DHW",)),
+    ("get_prog_actionids", ("DHW",)),
+    ("create_trigger", ("DHW", 0, "12:00", "1", "Once", "DHW Temporary")),
+    ("update_trigger", ("DHW", 0, "0", "1", "06:30")),
+    ("switch_triggers", ("DHW", "Active")),
+    ("delete_once_triggers", ("DHW",)),
+)
+
+# A plan step that reads the whole of a table (or builds a throwaway index over it)
+FULL_SCAN = re.compile(r"^SCAN (?!CONSTANT ROW)(?!\()|AUTOMATIC (COVERING |PARTIAL )?INDEX")
+
+
+def copy_database(in_source, in_destination):
+    # The backup API gives a consistent copy even while the controller is writing to the database
+    source = sqlite3.connect(in_source)
+    destination = sqlite3.connect(in_destination)
+    source.backup(destination)
+    destination.close()
+    source.close()
+
+
+def check_query_plans(inDatabaseFilename, inLogger):
+    # Runs the HOT_QUERIES against a copy of the database (some of them write) and returns
+    # [(method, sql, plan step), ...] for every step of their query plans that scans a whole table
+    import Database
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = f"{directory}/{os.path.basename(inDatabaseFilename)}"
+        copy_database(inDatabaseFilename, filename)
+        history_database_name = f"{os.path.dirname(inDatabaseFilename)}/controller_history.db"
+        if os.path.exists(history_database_name):
+            copy_database(history_database_name, f"{directory}/controller_history.db")
+
+        # This also checks the migration creates the indexes
+        migrate_database(filename, inLogger)
+        database = Database.Database(filename, inLogger)
+        connection = database.dbConnection
+
+        scans = []
+        for method, args in HOT_QUERIES:
+            statements = []
+            connection.set_trace_callback(statements.append)
+            try:
+                getattr(database, method)(*args)
+            except (TypeError, IndexError, KeyError) as error:
+                # Nothing matching in this database - the query has still been traced
+                inLogger.debug("schema check_query_plans %s %s", method, error)
+            connection.set_trace_callback(None)
+
+            # Statements are traced again for each row that fires a trigger
+            for statement in dict.fromkeys(statements):
+                if statement.split(None, 1)[0].lower() not in ("select", "update", "delete", "insert", "with"):
+                    continue
+                for step in connection.execute(f"explain query plan {statement}"):
+                    inLogger.debug("schema check_query_plans %s %s", method, step["detail"])
+                    if FULL_SCAN.search(step["detail"]):
+                        scans.append((method, statement, step["detail"]))
+
+        connection.rollback()
+        database.close()
+        return scans
+
+
+# The controller's tables as they were before any of the migrations above, for the regression check
+FIXTURE_SCHEMA = """
+    create table Gateway (GatewayId integer, GatewayName text, BrokerHost text, ClientId text,
+        SubscribeTopic text, PublishTopic text, Username text, Password text, LastSeen integer);
+    create table Node (NodeId integer, GatewayId integer, MySensorsNodeId integer, NodeName text, LastSeen integer);
+    create table Sensor (SensorId integer, NodeId integer, MySensorsSensorId integer, SensorName text,
+        VariableType text, CurrentValue text, LastSeen integer);
+    create table Action (ActionId integer, SensorName text, VariableType text, SetValue text,
+        TimedTriggerToUpdate integer, LastSeen integer);
+    create table TimedTrigger (TimedTriggerId integer, Time text, ActionId integer, Description text,
+        Day integer, Status text, LastSeen integer);
+    create table State (Name text, Value text);
+"""
+
+FIXTURE_SENSORS = ("Outside Temperature", "Operating Mode", "DHW Mode", "Hot Water Temperature",
+                   "Set Hot Water Temperature", "Heating Mode", "Buffer Temperature", "Set Buffer Temperature",
+                   "Compressor Idle", "Radiators relay", "Ufloor ground relay", "Ufloor first relay",
+                   "Current Watts", "Day Total Energy WH")
+
+FIXTURE_PROGRAMMES = ("DHW", "HC", "Radiators relay", "Ufloor ground relay", "Ufloor first relay")
+
+
+def create_fixture(in_directory):
+    # A small controller.db (and controller_history.db) in in_directory with the original schema, one gateway
+    # and node, the dashboard's sensors and a two period weekly programme for each relay
+    # Returns the controller database's filename
+    filename = f"{in_directory}/controller.db"
+    connection = sqlite3.connect(filename)
+    with connection:
+        connection.executescript(FIXTURE_SCHEMA)
+        connection.execute("insert into State values ('LastSeconds', '0')")
+        connection.execute("insert into Gateway values (1, 'Gateway', 'localhost', 'controller', "
+                           "'mysensors-out', 'mysensors-in', '', '', 0)")
+        connection.execute("insert into Node values (1, 1, 1, 'Node', 0)")
+        connection.executemany("insert into Sensor values (?, 1, ?, ?, 'V_STATUS', '0', 0)",
+                               [(sensor_id, sensor_id, name) for sensor_id, name in enumerate(FIXTURE_SENSORS, 1)])
+
+        action_id = 0
+        trigger_id = 0
+        for sensor_name in FIXTURE_PROGRAMMES:
+            action_ids = {}
+            for set_value in ("0", "1"):
+                action_id += 1
+                action_ids[set_value] = action_id
+                connection.execute("insert into Action values (?, ?, 'V_STATUS', ?, null, 0)",
+                                   (action_id, sensor_name, set_value))
+            for day in range(7):
+                for group, times in enumerate((("06:30:00", "08:00:00"), ("17:00:00", "22:30:00"))):
+                    for set_value, switch_time in zip(("1", "0"), times):
+                        trigger_id += 1
+                        connection.execute("insert into TimedTrigger values (?, ?, ?, ?, ?, 'External', 0)",
+                                           (trigger_id, switch_time, action_ids[set_value],
+                                            f"{sensor_name} Prog {day} {group} {set_value}", day))
+    connection.close()
+
+    connection = sqlite3.connect(f"{in_directory}/controller_history.db")
+    with connection:
+        connection.execute("create table sensor_history (SensorId integer, Value text, Time integer)")
+    connection.close()
+    return filename
+
+
+# python modules/Schema.py --migrate <controller database>
+# Brings the database up to date (with the controller and web2py stopped), exits non-zero if it is not in WAL mode
+# python modules/Schema.py [<controller database>]
+# Exits non-zero if any of the hot queries would scan a whole table in the given database,
+# or in one made by create_fixture() if none is given
+if __name__ == "__main__":
+    logger = logging.getLogger("schema")
+
+    if len(sys.argv) == 3 and sys.argv[1] == "--migrate":
+        journal_modes = migrate_database(sys.argv[2], logger)
+        if journal_modes != ["wal", "wal"]:
+            sys.exit(f"migrated, but not in WAL mode (main, history: {journal_modes}) - is something else using it?")
+        print(f"{sys.argv[2]} migrated to schema version {SCHEMA_VERSION}")
+        sys.exit()
+
+    if len(sys.argv) > 2 or (len(sys.argv) == 2 and sys.argv[1].startswith("-")):
+        sys.exit(f"usage: {sys.argv[0]} [--migrate] [<controller database>]")
+
+    with tempfile.TemporaryDirectory() as fixture_directory:
+        database_filename = sys.argv[1] if len(sys.argv) == 2 else create_fixture(fixture_directory)
+        full_scans = check_query_plans(database_filename, logger)
+    for method, statement, step in full_scans:
+        print(f"{method}: {step}\n    {' '.join(statement.split())}")
+    if len(full_scans) > 0:
+        sys.exit(f"{len(full_scans)} full table scans")
+    print(f"{len(HOT_QUERIES)} queries checked, no full table scans")
@@ -0,0 +1,32 @@
+# Times how long the models take to run for each request - the work done before any action runs
+# Run from the web2py folder, once with production = false in appconfig.ini and once with it true:
+#     python web2py.py -S ha1 -R applications/ha1/private/benchmark_models.py -A 200
+# The first run in the process (startup) is shown separately from the rest
+# No numbers have been recorded yet for either profile - the production profile's speed up is unmeasured
+import copy
+import statistics
+import sys
+import time
+
+from gluon.compileapp import build_environment, run_models_in
+from gluon.contrib.appconfig import AppConfig
+from gluon.globals import Response, Session
+
+requests = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+
+timings = []
+for count in range(requests + 1):
+    # A fresh environment each time, as web2py builds for each request
+    model_request = copy.copy(request)
+    environment = build_environment(model_request, Response(), Session())
+    started = time.perf_counter()
+    run_models_in(environment)
+    timings.append((time.perf_counter() - started) * 1000)
+
+production = AppConfig().get('app.production')
+print(f"models for {request.application} ({'production' if production else 'development'} profile)")
+print(f"startup   {timings[0]:8.2f} ms")
+print(f"requests  {requests}")
+print(f"mean      {statistics.mean(timings[1:]):8.2f} ms")
+print(f"median    {statistics.median(timings[1:]):8.2f} ms")
+print(f"max       {max(timings[1:]):8.2f} ms")
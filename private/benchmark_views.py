@@ -0,0 +1,38 @@
+# Times how long each of the default controller's views takes to render and how big the page is
+# Run from the web2py folder, with controller.db (appconfig.ini) in place:
+#     python web2py.py -S ha1/default -M -R applications/ha1/private/benchmark_views.py -A 200
+# Each action is called once for its data, only the rendering of its view is timed.
+# The first render of each view (when web2py reads it) is shown separately from the rest
+# No numbers have been recorded yet, before or after the views were merged
+import statistics
+import sys
+import time
+
+renders = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+
+# action, request.vars
+views = [("index", {}),
+         ("indexB", {}),
+         ("indexZ", {}),
+         ("prog", {"sensor": "DHW", "title": "Hot water"}),
+         ("progB", {"sensor": "DHW", "title": "Hot water"}),
+         ("allprog", {})]
+
+print(f"views for {request.application} ({renders} renders each)")
+print(f"{'action':10} {'view':24} {'bytes':>8} {'first':>10} {'mean':>10} {'median':>10} {'max':>10}")
+for action, action_vars in views:
+    request.function = action
+    request.vars.clear()
+    request.vars.update(action_vars)
+    response.files = []
+    response.view = f"default/{action}.html"
+    data = globals()[action]()
+
+    timings = []
+    for count in range(renders + 1):
+        started = time.perf_counter()
+        page = response.render(response.view, data)
+        timings.append((time.perf_counter() - started) * 1000)
+
+    print(f"{action:10} {response.view:24} {len(page):8} {timings[0]:8.2f}ms {statistics.mean(timings[1:]):8.2f}ms "
+          f"{statistics.median(timings[1:]):8.2f}ms {max(timings[1:]):8.2f}ms")
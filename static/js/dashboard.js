@@ -0,0 +1,89 @@
+// The dashboard (default/index) - the on / off buttons, the next switch times and keeping the values up to date
+// The page sets: var dashboard = {setsensor_url: ..., changes_url: ..., live_version: ...};
+// where live_version is null for the variants whose values are not kept up to date
+
+$(function() {
+    // The on / off buttons, each one's next switch time is in the input with its id less "_relay"
+    $("p[data-live-relay]").click(function() {
+        var this_id = $(this).attr("id");
+        var target_time_id = this_id.substring(0, this_id.length-6);
+        var set_value = 0;
+        if ($(this).hasClass("on")) {
+          $(this).toggleClass("on");
+          $(this).toggleClass("off");
+          $(this).text("off");
+          set_value = 0;
+        }
+        else {
+          $(this).toggleClass("off");
+          $(this).toggleClass("on");
+          $(this).text("on");
+          set_value = 1;
+        };
+        $.ajax({
+            url: dashboard.setsensor_url,
+            data: { sensor: $(this).attr("name"), value: set_value }
+          })
+          .done(function(msg) {
+                $("#"+target_time_id).val(msg);
+            });
+    });
+
+    // The next switch times, sent with the state of the button for the same sensor
+    $("input.myspin").on("change",
+        function() {
+            var state = 0;
+            var regexp = /\b([01][0-9]|[02][0-3]):[0-5][0-9]$/;
+            var valid_time = ($(this).val().search(regexp) >= 0) ? true : false;
+            var relay = $("#" + $(this).attr("id") + "_relay");
+            if (valid_time) {
+                if ( relay.attr("class") == "on" ) { state = 1 };
+                $.ajax({
+                    url: dashboard.setsensor_url,
+                    data: { sensor: relay.attr("name"), value: state, time:  $(this).val()} });
+                $(this).blur();
+                }
+            else {
+                alert("Invalid time");
+                $(this).focus();
+                };
+        }
+    );
+
+    // Keep the values on the page up to date - the server only answers when something has changed
+    var live_version = dashboard.live_version;
+
+    function live_update(name, value) {
+        $("[data-live='" + name + "']").each(function() {
+            if ($(this).is("input")) {
+                if (!$(this).is(":focus")) { $(this).val(value); };
+            }
+            else {
+                $(this).text(value);
+            };
+        });
+        $("[data-live-kwh='" + name + "']").text((parseFloat(value) / 1000).toFixed(2));
+        $("[data-live-relay='" + name + "']").each(function() {
+            var on = (value === true || value == "1");
+            $(this).toggleClass("on", on).toggleClass("off", !on).text(on ? "on" : "off");
+        });
+    }
+
+    function live_poll() {
+        $.ajax({
+                url: dashboard.changes_url,
+                data: { version: live_version },
+                dataType: "json"
+               })
+         .done(function(data) {
+                live_version = data.version;
+                $.each(data.changes, live_update);
+                live_poll();
+            })
+         .fail(function() {
+                setTimeout(live_poll, 10000);
+            });
+    }
+
+    if (live_version) { live_poll(); };
+});
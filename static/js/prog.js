@@ -0,0 +1,23 @@
+// A programme (default/prog) - each input is a switch time, its id is sensor/day/group/value
+// The page sets: var prog = {settrigger_url: ...};
+
+$(function() {
+    $("input").on("change",
+        function() {
+            var regexp = /\b([01][0-9]|[02][0-3]):[0-5][0-9]$/;
+            var valid_time = ($(this).val().search(regexp) >= 0) ? true : false;
+            if (valid_time) {
+                var details = $(this).attr("id").split("/");
+                $.ajax({
+                        url: prog.settrigger_url,
+                        data: { sensor: details[0], day: details[1], group: details[2], value: details[3], time: $(this).val()+":00" }
+                       });
+                $(this).blur();
+            }
+            else {
+                alert("Invalid time");
+                $(this).focus();
+            };
+        }
+    );
+});